@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+# TabloBench, M Tuckman 2014
+# Throughput benchmarks for TabloToGo.v1.py, run against a stand-in Tablo served locally so no
+# real Tablo is needed on the network.
+
+# Usage: ./TabloBench.py <options>
+#  Options:    -recordings:N   recordings on the fake tablo (default 500)
+#              -recording:N    how many of those are still recording (default 5)
+#              -segments:N     segments per recording (default 200)
+#              -segsize:KB     size of each segment (default 1024)
+#              -latency:MS     delay added to every request the fake tablo answers (default 0)
+#              -workers:N      segment download workers (default 4)
+#              -metaworkers:N  metadata fetch workers (default 8)
+#              -dbsizes:N:N:.. recordings to time the database with (default 100:1000:10000)
+#              -port:N         port to serve the fake tablo on (default 18080)
+#              -temp:dir       where staged segments are written (default a new temporary dir)
+
+# Process overview:
+# 1. start_tablo() serves a synthetic /pvr listing, meta.txt for TV and movie recordings, and
+#    /segs listings and segments in the same lighttpd directory listing format as a tablo.
+# 2. bench_listing() times parse_listing on the /pvr and /segs pages, in entries/second.
+# 3. bench_sweep() times db_update against it, first on an empty database and then again
+#    with nothing changed, and reports recordings/second.
+# 4. bench_transfer() times get_segments (network only) and fetch_video (staged to temp),
+#    and reports MB/second.
+# 5. bench_db() times db_save, db_load and a single row save with databases of each size.
+
+#################################################################################################
+# Import required libraries
+import os,sys,string,time,imp,json,shutil,tempfile,threading,BaseHTTPServer,SocketServer
+T = imp.load_source('tablo2go', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TabloToGo.v1.py'))
+
+#################################################################################################
+# Settings for the fake tablo, changed from the command line
+FAKE = {'recordings':500, 'recording':5, 'segments':200, 'segsize':1024*1024, 'latency':0.0}
+FIRST_ID = 100000
+
+#################################################################################################
+# Function to build one row of a lighttpd directory listing, a directory (NAME ending in /) has
+# its / after the link
+def fake_row(NAME, SIZE, TYPE):
+    if NAME[-1:] == '/':
+        return '<tr><td class="n"><a href="'+NAME+'">'+NAME[:-1]+'</a>/</td><td class="m">2014-Oct-12 20:00:01</td><td class="s">'+SIZE+'</td><td class="t">'+TYPE+'</td></tr>\n'
+    return '<tr><td class="n"><a href="'+NAME+'">'+NAME+'</a></td><td class="m">2014-Oct-12 20:00:01</td><td class="s">'+SIZE+'</td><td class="t">'+TYPE+'</td></tr>\n'
+
+#################################################################################################
+# Function to build a whole directory listing page from its rows
+def fake_listing(ROWS):
+    return '<html><head><title>Index</title></head><body><table>\n'+fake_row('../', '- &nbsp;', 'Directory')+string.join(ROWS, '')+'</table></body></html>\n'
+
+#################################################################################################
+# Function to build the meta.txt of a recording, odd ids are movies, even ids TV episodes, and the
+# first FAKE['recording'] ids are still recording
+def fake_meta(VIDEOID):
+    index = VIDEOID - FIRST_ID
+    state = 'finished'
+    if index < FAKE['recording']:
+        state = 'recording'
+    if index % 2:
+        return {'recMovie': {'jsonForClient': {'title': 'Movie '+str(index), 'releaseYear': 1950+index%60, 'plot': 'A synthetic movie.'}},
+                'recMovieAiring': {'jsonForClient': {'airDate': '2014-10-12T20:00Z', 'video': {'state': state}}}}
+    return {'recSeries': {'jsonForClient': {'title': 'Series '+str(index%40)}},
+            'recSeason': {'jsonForClient': {'seasonNumber': index%9+1}},
+            'recEpisode': {'jsonForClient': {'title': 'Episode '+str(index), 'seasonNumber': index%9+1, 'episodeNumber': index%20+1,
+                                             'description': 'A synthetic episode.', 'originalAirDate': '2010-01-01', 'airDate': '2014-10-12T20:00Z',
+                                             'video': {'state': state}}}}
+
+#################################################################################################
+# Request handler for the fake tablo, speaks HTTP/1.1 so keep-alive connections are exercised
+class FakeTablo(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, *args):
+        return
+
+    def reply(self, BODY, TYPE, ETAG=None):
+        if ETAG is not None and self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', TYPE)
+        self.send_header('Content-Length', str(len(BODY)))
+        if ETAG is not None:
+            self.send_header('ETag', ETAG)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(BODY)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if FAKE['latency']:
+            time.sleep(FAKE['latency'])
+        path = string.splitfields(string.strip(self.path, '/'), '/')
+        try:
+            if path == ['pvr']:
+                return self.reply(self.server.pvr, 'text/html')
+            VIDEOID = int(path[1])
+            if path[0] != 'pvr' or VIDEOID < FIRST_ID or VIDEOID >= FIRST_ID+FAKE['recordings']:
+                raise ValueError
+            if path[2:] == ['meta.txt']:
+                meta = json.dumps(fake_meta(VIDEOID))
+                return self.reply(meta, 'text/plain', '"'+str(VIDEOID)+'-'+str(len(meta))+'"')
+            if path[2:] == ['segs']:
+                return self.reply(self.server.segs, 'text/html')
+            if path[2] == 'segs' and len(path) == 4 and 1 <= int(path[3][:-3]) <= FAKE['segments']:
+                return self.reply(self.server.segment, 'video/mp2t')
+        except (ValueError, IndexError):
+            ohwell = 1
+        self.send_error(404)
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+#################################################################################################
+# Function to start the fake tablo in a background thread, the listings and segment payload are
+# built once up front so the server costs as little as possible
+def start_tablo(PORT):
+    server = FakeServer(('127.0.0.1', PORT), FakeTablo)
+    rows = []
+    for index in range(FAKE['recordings']):
+        rows.append(fake_row(str(FIRST_ID+index)+'/', '- &nbsp;', 'Directory'))
+    server.pvr = fake_listing(rows)
+    size = max(1, FAKE['segsize']/188)
+    server.segment = ('\x47'+'\xff'*187)*size
+    rows = []
+    for counter in range(1, FAKE['segments']+1):
+        rows.append(fake_row(string.zfill(counter,5)+'.ts', str(round(len(server.segment)/1048576.0, 1))+'M', 'video/mp2t'))
+    server.segs = fake_listing(rows)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(1)
+    t.start()
+    return server
+
+#################################################################################################
+# Function to print one benchmark result line
+def report(NAME, VALUE, UNIT, SECONDS):
+    print string.ljust(NAME, 40), string.rjust('%.1f' % VALUE, 10), string.ljust(UNIT, 14), '(%.3fs)' % SECONDS
+
+#################################################################################################
+# Time a full metadata sweep into an empty database, then a sweep where nothing has changed
+def bench_sweep(TEMPDIR, METAWORKERS):
+    T.pool_close()
+    DATABASE = TEMPDIR+'/sweep.db'
+    DB = T.db_load(DATABASE)
+    start = time.time()
+    DB, found_count, add_count, del_count, proc_count = T.db_update(['127.0.0.1'], DB, METAWORKERS)
+    elapsed = time.time() - start
+    report('sweep, new database', found_count/elapsed, 'recordings/s', elapsed)
+    T.db_save(DATABASE, DB)
+    start = time.time()
+    DB, found_count, add_count, del_count, proc_count = T.db_update(['127.0.0.1'], DB, METAWORKERS)
+    elapsed = time.time() - start
+    report('sweep, nothing changed', found_count/elapsed, 'recordings/s', elapsed)
+
+#################################################################################################
+# Time parsing the /pvr and /segs listings the fake tablo serves, ROUNDS times each
+def bench_listing(SERVER, ROUNDS=100):
+    for name, page, kind in [('pvr', SERVER.pvr, '/'), ('segs', SERVER.segs, '.ts')]:
+        start = time.time()
+        for i in range(ROUNDS):
+            entries = T.parse_listing(page, kind)
+        elapsed = time.time() - start
+        report('listing, /'+name+' ('+str(len(entries))+' entries)', len(entries)*ROUNDS/elapsed, 'entries/s', elapsed)
+
+#################################################################################################
+# Time segment transfers, first straight off the network and then staged to TEMPDIR
+def bench_transfer(TEMPDIR, WORKERS):
+    T.pool_close()
+    VIDEOID = str(FIRST_ID+FAKE['recording'])
+    received = [0]
+    def writer(SEGMENT, DATA):
+        received[0] = received[0] + len(DATA)
+    start = time.time()
+    T.get_segments('127.0.0.1', VIDEOID, range(1, FAKE['segments']+1), writer, WORKERS, 0, 64*1024*1024, 0)
+    elapsed = time.time() - start
+    report('transfer, network only ('+str(WORKERS)+' workers)', received[0]/1048576.0/elapsed, 'MB/s', elapsed)
+    start = time.time()
+    segments = T.fetch_video('127.0.0.1', VIDEOID, TEMPDIR, TEMPDIR, '', VIDEOID, 0, 0, WORKERS, 0)
+    elapsed = time.time() - start
+    report('transfer, staged to temp ('+str(WORKERS)+' workers)', received[0]/1048576.0/elapsed, 'MB/s', elapsed)
+    for counter in segments:
+        os.remove(TEMPDIR+'/'+VIDEOID+'-'+string.zfill(counter,5)+'.ts')
+    os.remove(TEMPDIR+'/'+VIDEOID+'.progress')
+
+#################################################################################################
+# Time database saves and loads with SIZE synthetic recordings
+def bench_db(TEMPDIR, SIZE):
+    DATABASE = TEMPDIR+'/bench'+str(SIZE)+'.db'
+    DB = {'complete':{}, 'config':{}, 'dirty':{}, '127.0.0.1':{}}
+    for index in range(SIZE):
+        ID = str(FIRST_ID+index)
+        DB['127.0.0.1'][ID] = T.proc_meta(fake_meta(FIRST_ID+index % FAKE['recordings']))
+        T.db_mark(DB, '127.0.0.1', ID)
+    start = time.time()
+    T.db_save(DATABASE, DB)
+    elapsed = time.time() - start
+    report('db save, '+str(SIZE)+' new recordings', SIZE/elapsed, 'recordings/s', elapsed)
+    start = time.time()
+    DB = T.db_load(DATABASE)
+    elapsed = time.time() - start
+    report('db load, '+str(SIZE)+' recordings', SIZE/elapsed, 'recordings/s', elapsed)
+    ID = str(FIRST_ID)
+    DB['127.0.0.1'][ID]['transfered'] = 'complete'
+    T.db_mark(DB, '127.0.0.1', ID)
+    start = time.time()
+    T.db_save(DATABASE, DB)
+    elapsed = time.time() - start
+    report('db save, 1 of '+str(SIZE)+' changed', 1/elapsed, 'saves/s', elapsed)
+
+#################################################################################################
+# Begin the program for command line use
+if __name__ == '__main__':
+    PORT = 18080
+    WORKERS = 4
+    METAWORKERS = 8
+    DBSIZES = [100, 1000, 10000]
+    TEMPDIR = ''
+    try:
+        for item in sys.argv[1:]:
+            tmp = string.splitfields(string.strip(item)[1:], ':', 1)
+            key, value = string.lower(tmp[0]), tmp[1:]
+            if key in ['recordings', 'recording', 'segments']:
+                FAKE[key] = int(value[0])
+            elif key == 'segsize':
+                FAKE['segsize'] = int(value[0])*1024
+            elif key == 'latency':
+                FAKE['latency'] = float(value[0])/1000.0
+            elif key == 'workers':
+                WORKERS = int(value[0])
+            elif key == 'metaworkers':
+                METAWORKERS = int(value[0])
+            elif key == 'dbsizes':
+                DBSIZES = map(int, string.splitfields(value[0], ':'))
+            elif key == 'port':
+                PORT = int(value[0])
+            elif key == 'temp':
+                TEMPDIR = value[0]
+            else:
+                raise ValueError(item)
+    except:
+        print 'Tablo Extractor Benchmarks (Version '+str(T.VERSION)+')'
+        print ' Usage: '+sys.argv[0]+' <options>'
+        print ' Options:    -recordings:N         Recordings on the fake Tablo (default 500)'
+        print '             -recording:N          How many of those are still recording (default 5)'
+        print '             -segments:N           Segments per recording (default 200)'
+        print '             -segsize:KB           Size of each segment (default 1024)'
+        print '             -latency:MS           Delay added to every request (default 0)'
+        print '             -workers:N            Segment download workers (default 4)'
+        print '             -metaworkers:N        Metadata fetch workers (default 8)'
+        print '             -dbsizes:N:N:..       Recordings to time the database with (default 100:1000:10000)'
+        print '             -port:N               Port to serve the fake Tablo on (default 18080)'
+        print '             -temp:dir             Where staged segments are written'
+        sys.exit()
+
+    CLEANUP = 0
+    if TEMPDIR == '':
+        TEMPDIR = tempfile.mkdtemp(prefix='tablobench')
+        CLEANUP = 1
+    T.TABLO_PORT = PORT
+    server = start_tablo(PORT)
+    print 'Fake Tablo on 127.0.0.1:'+str(PORT)+', '+str(FAKE['recordings'])+' recordings of '+str(FAKE['segments'])+' x '+str(FAKE['segsize']/1024)+'KB segments, '+str(int(FAKE['latency']*1000))+'ms latency'
+    try:
+        bench_listing(server)
+        bench_sweep(TEMPDIR, METAWORKERS)
+        bench_transfer(TEMPDIR, WORKERS)
+        for SIZE in DBSIZES:
+            bench_db(TEMPDIR, SIZE)
+    finally:
+        server.shutdown()
+        T.pool_close()
+        if CLEANUP:
+            shutil.rmtree(TEMPDIR, True)
@@ -11,12 +11,49 @@
 # Usage: ./tablo2go.py <options> "search regex"
 #  Options:    -tablo:IP_ADDR  tablo ip address (multiple tablos seperated by a colon)
 #              -ffmpeg:PATH    path to ffmpeg (ex /bin/ffmpeg)
-#              -db:file        Tablo Extractor Database File
+#              -db:file        Tablo Extractor Database File (SQLite, older files are converted)
 #              -output:dir     Save final files here
-#              -a              Reprocess ever 30 minutes, do not exit
+#              -watch:file     Process every search listed in file (one rule per line, see watch_load)
+#              -a              Keep running, checking the tablo(s) as often as needed, do not exit,
+#                              matches found while videos are transferring join those already queued
+#              -listpoll:S     With -a, check the listings every S seconds, backing off to -sleep (default 60)
+#              -fastpoll:S     With -a, check a recording every S seconds around its expected end (default 20)
 #              -list           List videos on Tablo(s)
+#              -json           List videos on Tablo(s) as JSON lines, one recording per line
+#              -maxage:S       With -list, -csv or -json, only check the tablo(s) if the database was
+#                              last brought up to date more than S seconds ago
+#              -cached         With -list, -csv or -json, answer from the database alone
 #              -handbrake      Post process with handbrake (and delete .mp4 file)
+#              -workers:N      Download N segments at once from each tablo (default 4)
+#              -retries:N      Retry a failed segment N times before giving up (default 3)
+#              -inflight:MB    Stop fetching ahead once MB of segments are waiting (default 64)
+#              -stream         Pipe segments straight into ffmpeg instead of staging them in temp
+#              -pool:N         Keep up to N connections open to each tablo (default 8)
+#              -timeout:S      Give up on a tablo request after S seconds (default 30)
+#              -metaworkers:N  Fetch N metadata files at once from each tablo (default 8)
+#              -downloaders:N  Download N videos at once (default -pertablo for each tablo)
+#              -pertablo:N     Download at most N videos at once from each tablo (default 1)
+#              -order:O        Download "watch" (watchlist order, the default), "newest" or
+#                              "shortest" videos first, from all tablos together
+#              -remuxers:N     Run N ffmpeg remuxes at once (default 1)
+#              -transcoders:N  Run N handbrake encodes at once, "auto" for one per core (default 1)
+#              -depth:N        Let up to N videos wait between stages (default 2)
+#              -follow:S       Download recordings in progress as they are written, checking every
+#                              S seconds with -a (default 60), the rest is fetched once they finish
+#              -tablorate:MB   Download at most MB megabytes a second from each tablo
+#              -maxrate:MB     Download at most MB megabytes a second from all tablos together
+#              -ratesched:HHMM-HHMM=T/A,..  Cap each tablo at T and all at A MB/s between those times
+#                              (0 for no cap), segment fetches also back off when a tablo slows down
+#              -diskfree:MB    Leave MB free on the temp and output disks, videos that do not fit wait
+#                              (default 1024), segments left in temp by a crashed run are removed
+#              -metrics:file   Append a JSON line with the timing of every stage to file
+#              -metricsport:N  With -a, serve counters and timers on http://localhost:N/metrics
+# Only what changed is looked at again: a tablo whose /pvr listing is unchanged costs one request,
+# and recordings in progress are re-fetched with a conditional request.
 #  Note: Search Terms are optional and should be in a quote if more than one word.
+#        A search with field:value terms is answered from the database indexes instead, e.g.
+#        "series:Nova season:>=3 status:finished", "desc:volcano airdate:2014-01-01..2014-06-30"
+#        (fields: series title season episode airdate status type transferred tablo id name desc)
 
 # Example usage:
 # ./tablo2go.py -db:/tmp/tablo2go.db -tablo:192.168.2.168 -ffmpeg:/src/ffmpeg/bin/ffmpeg -output:/share/Tablo -handbrake
@@ -31,20 +68,32 @@
 #    return a dictionary with {'ids': {'VIDEOID1':IPADDR, 'VIDEOID2':IPADDR, etc..}}
 # 2. via get_meta(IPADDR, VIDEOID), view http://IPADDR:18080/pvr/VIDEOID/meta.txt to retrieve
 #    associated metadata, returned in a dictionary {}
-# 3. via proc_meta(IPADDR, VIDEOID, DATABASE), review metadata retrieved via step 2, searching
+# 3. via proc_meta(METADATA), review metadata retrieved via step 2, searching
 #    for series, season, episode, title, airdate, originalairdate, description, and recording
-#    status and update database with this information.
+#    status and update database with this information.  Only these fields are kept in memory
+#    (a Recording), the metadata itself is written to the database compressed (see db_meta).
 # These are all called in turn via db_update(TABLOS, DB), which looks for new shows, aquires
 # the metadata for only those shows that it has not processed before, processes the metadata,
 # deletes shows that are no longer available from the database, revisists those that were
-# recording previously.
+# recording previously.  The tablos are polled at the same time and their metadata files are
+# fetched by a pool of worker threads.
 # 4. if a search string is entered only process items that match, and that have finished recording,
-#    and that have not been processed in the past.
+#    and that have not been processed in the past.  Field queries (series:Nova season:>=3) are
+#    answered by db_search from the indexed columns and the terms table kept up by db_save.
+#    With -watch every rule in the watchlist is matched against the same sweep (search_match) and
+#    the matches are queued once, each with the output directory and handbrake setting of its rule.
 # 5. via get_video(IPADDR, VIDEOID, DIRECTORY, FFMPEG, FILENAME), each .ts file at
-#    http://IPADDR:18080/pvr/VIDEOID/segs is downloaded to tmp (with a prepended UUID), upon
-#    completion, it is rebuild using the ffmpeg command noted on the discussion board
-#    at http://community.tablotv.com/discussion/226/can-i-pull-recorded-video-files-off-tablo via
+#    http://IPADDR:18080/pvr/VIDEOID/segs is downloaded to tmp (with a prepended VIDEOID) by a
+#    pool of worker threads (get_segments), each segment is retried with a growing delay on
+#    failure and written out in order, upon completion, it is rebuild using the ffmpeg command
+#    noted on the discussion board at
+#    http://community.tablotv.com/discussion/226/can-i-pull-recorded-video-files-off-tablo via
 #    FFMPEG -i "concat:file1.ts|file2.ts|.." -bsf:a aac_adtstoasc -c copy "DIRECTORY/FILENAME.mp4"'
+#    (with -stream the segments are instead written to ffmpeg's stdin as they arrive, "-i pipe:0")
+#    Staged segments are checkpointed in TEMPDIR/VIDEOID.progress, after a crash or restart only
+#    the missing segments are fetched again.  Every segment is checked to be whole MPEG-TS
+#    (check_segment) and fetched again if not.  Finished files are catalogued by series, season
+#    and episode (catalog_key), the same show recorded on another tablo is not downloaded again.
 #    For TV shows this ends up as /DIRECTORY/Series_Name/Series_Name - S01E01 - Episode.mp4",
 #    for Movies this would be /DIRECTORY/Movie_Name (Year).mp4".
 # 6. if postprocessing is desired, HandBrakeCLI is called with (my traditional kmttg settings)
@@ -52,91 +101,1032 @@
 #    --loose-anamorphic --modulus 2 -m --x264-preset medium --h264-profile high --h264-level 4.1
 #    --decomb --denoise=weak -v -o "'+DIRECTORY/FILENAME.mkv"
 #    and the original mp4 is deleted.
-# 7. Mark within the database as processed, move onto the next file, loop as necessary if
-#    ran as a service.
+# 7. Mark within the database as processed, loop as necessary if ran as a service.
+#    Steps 5 and 6 run as a pipeline (see pipeline()), so the next video downloads while the
+#    previous one is being remuxed or transcoded.  Videos from every tablo share one queue (see
+#    order_jobs), with -pertablo limiting how many download from the same tablo at once.
+#    The database is an SQLite file with a row per recording, only rows flagged via db_mark are
+#    rewritten by db_save.
 
 #################################################################################################
 # Import required libraries
 VERSION = 0.23
-import os,sys,string,time,urllib,uuid,re,subprocess,urllib2
+import os,sys,string,time,re,subprocess,threading,Queue,httplib,sqlite3,ast,hashlib,multiprocessing,json,socket,BaseHTTPServer,shlex,calendar,zlib
 global true, false
 true, false = 1, 0
 #DEBUG = true
 
+#################################################################################################
+# Counters and timers for every stage, kept as {(NAME, LABELS): value}, timers as [count, sum]
+# Timed stages are also written to METRICS_LOG (one JSON object per line) if one is open.
+METRICS = {'counters':{}, 'timers':{}}
+METRICS_LOCK = threading.Lock()
+METRICS_LOG = None
+
+#################################################################################################
+# Function to open the JSON-lines metrics log, lines are appended to FILENAME
+def metrics_open(FILENAME):
+    global METRICS_LOG
+    METRICS_LOG = open(FILENAME, 'a')
+
+#################################################################################################
+# Function to add VALUE to a counter
+def metric_count(NAME, VALUE=1, LABELS={}):
+    key = (NAME, tuple(sorted(LABELS.items())))
+    METRICS_LOCK.acquire()
+    METRICS['counters'][key] = METRICS['counters'].get(key, 0) + VALUE
+    METRICS_LOCK.release()
+
+#################################################################################################
+# Function to record how long a stage took, with LOG set the stage (and any EXTRA fields) is
+# also written to the metrics log
+def metric_time(NAME, SECONDS, LABELS={}, EXTRA={}, LOG=1):
+    key = (NAME, tuple(sorted(LABELS.items())))
+    METRICS_LOCK.acquire()
+    timer = METRICS['timers'].setdefault(key, [0, 0.0])
+    timer[0] = timer[0] + 1
+    timer[1] = timer[1] + SECONDS
+    if LOG and METRICS_LOG is not None:
+        line = {'time':round(time.time(), 3), 'metric':NAME, 'seconds':round(SECONDS, 4)}
+        line.update(LABELS)
+        line.update(EXTRA)
+        METRICS_LOG.write(json.dumps(line)+'\n')
+        METRICS_LOG.flush()
+    METRICS_LOCK.release()
+
+#################################################################################################
+# Function to render the metrics in the Prometheus text format
+def metrics_text():
+    lines = []
+    METRICS_LOCK.acquire()
+    for kind, suffixes in [('counters', ['']), ('timers', ['_count', '_sum'])]:
+        keys = METRICS[kind].keys()
+        keys.sort()
+        seen = {}
+        for NAME, LABELS in keys:
+            if not seen.has_key(NAME):
+                seen[NAME] = 1
+                lines.append('# TYPE tablo_'+NAME+' '+{'counters':'counter', 'timers':'summary'}[kind])
+            labels = ''
+            if LABELS:
+                labels = '{'+string.join(['%s="%s"' % item for item in LABELS], ',')+'}'
+            value = METRICS[kind][(NAME, LABELS)]
+            if kind == 'counters':
+                value = [value]
+            for i in range(len(suffixes)):
+                lines.append('tablo_'+NAME+suffixes[i]+labels+' '+repr(value[i]))
+    METRICS_LOCK.release()
+    return string.join(lines, '\n')+'\n'
+
+#################################################################################################
+# Function to serve metrics_text() on http://localhost:PORT/metrics from a background thread
+def metrics_serve(PORT):
+    class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics_text()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            return
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', PORT), handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(1)
+    t.start()
+    return server
+
+#################################################################################################
+# Keep-alive connections to each tablo, shared by get_list, get_segs, get_meta and get_video
+# POOL = {IPADDR: {'idle': [connections], 'slots': semaphore}}
+POOL = {}
+POOL_LOCK = threading.Lock()
+POOL_SIZE = 8           # most connections open to a single tablo at once
+POOL_TIMEOUT = 30.0     # seconds to wait on a tablo before giving up on a request
+TABLO_PORT = 18080      # port the tablo web server listens on
+
+#################################################################################################
+# Function to set the size and timeout of the connection pool, idle connections are dropped
+def pool_config(SIZE, TIMEOUT):
+    global POOL_SIZE, POOL_TIMEOUT
+    pool_close()
+    POOL_SIZE = max(1, SIZE)
+    POOL_TIMEOUT = TIMEOUT
+
+#################################################################################################
+# Function to close every idle connection in the pool
+def pool_close():
+    POOL_LOCK.acquire()
+    for IPADDR in POOL.keys():
+        for conn in POOL[IPADDR]['idle']:
+            conn.close()
+    POOL.clear()
+    POOL_LOCK.release()
+
+#################################################################################################
+# Function to make a request to a tablo over a pooled connection, returns (status, headers, body)
+# A reused connection the tablo has already dropped is retried once on a fresh connection.
+def tablo_request(IPADDR, PATH, METHOD='GET', HEADERS={}):
+    POOL_LOCK.acquire()
+    if not POOL.has_key(IPADDR):
+        POOL[IPADDR] = {'idle':[], 'slots':threading.BoundedSemaphore(POOL_SIZE)}
+    entry = POOL[IPADDR]
+    POOL_LOCK.release()
+    entry['slots'].acquire()
+    start = time.time()
+    try:
+        attempt = 0
+        while 1:
+            POOL_LOCK.acquire()
+            if entry['idle']:
+                conn, reused = entry['idle'].pop(), 1
+            else:
+                conn, reused = httplib.HTTPConnection(IPADDR, TABLO_PORT, timeout=POOL_TIMEOUT), 0
+            POOL_LOCK.release()
+            try:
+                conn.request(METHOD, PATH, None, HEADERS)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                attempt = attempt + 1
+                if reused and attempt == 1:
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                POOL_LOCK.acquire()
+                entry['idle'].append(conn)
+                POOL_LOCK.release()
+            kind = string.splitfields(PATH, '/')[-1]
+            if kind not in ['pvr', 'meta.txt', 'segs']:
+                kind = 'segment'
+            metric_time('request_seconds', time.time()-start, {'tablo':IPADDR, 'kind':kind}, LOG=0)
+            metric_count('bytes_total', len(body), {'tablo':IPADDR})
+            return resp.status, dict(resp.getheaders()), body
+    finally:
+        entry['slots'].release()
+
+#################################################################################################
+# Function to fetch a page from a tablo, raises IOError for anything but a successful response
+def tablo_get(IPADDR, PATH):
+    status, headers, body = tablo_request(IPADDR, PATH)
+    if status < 200 or status > 299:
+        raise IOError('HTTP '+str(status)+' retrieving http://'+IPADDR+':'+str(TABLO_PORT)+PATH)
+    return body
+
+#################################################################################################
+# Bandwidth caps for segment downloads in MB/s (0 for none), RATE_TABLO applies to each tablo
+# and RATE_ALL to all of them together.  RATE_SCHEDULE is a list of (FROM, TO, TABLO, ALL)
+# with FROM and TO in minutes past midnight, the first one covering the time of day replaces
+# the caps.  Each cap is a bucket that is drawn down by every segment and refilled at its rate.
+RATE_TABLO = 0
+RATE_ALL = 0
+RATE_SCHEDULE = []
+RATE_BUCKETS = {}       # IPADDR or '*': [bytes available, last refilled]
+RATE_LOCK = threading.Lock()
+
+#################################################################################################
+# Function to set the bandwidth caps, SCHEDULE as given to -ratesched (HHMM-HHMM=TABLO/ALL,...)
+def rate_config(TABLO, ALL, SCHEDULE=''):
+    global RATE_TABLO, RATE_ALL, RATE_SCHEDULE
+    schedule = []
+    for item in string.split(SCHEDULE, ','):
+        if string.strip(item) == '':
+            continue
+        times, caps = string.splitfields(string.strip(item), '=', 1)
+        start, end = string.splitfields(times, '-', 1)
+        caps = string.splitfields(caps, '/', 1)
+        if len(caps) == 1:
+            caps.append(ALL)
+        schedule.append((int(start[:-2])*60+int(start[-2:]), int(end[:-2])*60+int(end[-2:]), float(caps[0]), float(caps[1])))
+    RATE_LOCK.acquire()
+    RATE_TABLO, RATE_ALL, RATE_SCHEDULE = float(TABLO), float(ALL), schedule
+    RATE_BUCKETS.clear()
+    RATE_LOCK.release()
+
+#################################################################################################
+# Function to return the caps (TABLO, ALL) in MB/s in effect at NOW
+def rate_caps(NOW):
+    now = time.localtime(NOW)
+    minute = now[3]*60 + now[4]
+    for start, end, tablo, all in RATE_SCHEDULE:
+        if start <= minute < end or (end < start and (minute >= start or minute < end)):
+            return tablo, all
+    return RATE_TABLO, RATE_ALL
+
+#################################################################################################
+# Function to account for BYTES received from a tablo, sleeps for as long as it takes the
+# tablo's bucket and the shared one to pay for them, returns the seconds slept
+def rate_take(IPADDR, BYTES):
+    RATE_LOCK.acquire()
+    now = time.time()
+    caps = rate_caps(now)
+    wait = 0.0
+    for key, cap in [(IPADDR, caps[0]), ('*', caps[1])]:
+        if cap <= 0:
+            continue
+        rate = cap * 1048576
+        bucket = RATE_BUCKETS.setdefault(key, [rate, now])
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate) - BYTES
+        bucket[1] = now
+        if bucket[0] < 0:
+            wait = max(wait, -bucket[0] / rate)
+    RATE_LOCK.release()
+    if wait > 0:
+        metric_count('throttle_seconds_total', wait, {'tablo':IPADDR})
+        time.sleep(wait)
+    return wait
+
+#################################################################################################
+# Segment fetches from each tablo are limited by an additive increase, multiplicative decrease
+# window: every fetch that comes back in good time lets the window grow by about one fetch per
+# window's worth, a failure halves it and a fetch taking more than twice the usual time cuts it
+# by a quarter (at most once per usual fetch time).  The window never exceeds the -workers count.
+# CONGESTION = {IPADDR: {'window', 'active', 'usual', 'cut'}}
+CONGESTION = {}
+CONGESTION_LOCK = threading.Condition()
+
+#################################################################################################
+# Function to wait for room in the tablo's window before fetching a segment
+def congestion_enter(IPADDR, WORKERS):
+    CONGESTION_LOCK.acquire()
+    state = CONGESTION.setdefault(IPADDR, {'window':float(WORKERS), 'active':0, 'usual':None, 'cut':0.0})
+    state['window'] = min(state['window'], float(WORKERS))
+    while state['active'] >= max(1, int(state['window'])):
+        CONGESTION_LOCK.wait(1.0)
+    state['active'] = state['active'] + 1
+    CONGESTION_LOCK.release()
+
+#################################################################################################
+# Function to report a fetch that took SECONDS, OK is 0 if it failed
+def congestion_leave(IPADDR, WORKERS, SECONDS, OK):
+    CONGESTION_LOCK.acquire()
+    state = CONGESTION[IPADDR]
+    state['active'] = state['active'] - 1
+    now = time.time()
+    if not OK:
+        state['window'] = max(1.0, state['window'] / 2)
+        state['cut'] = now
+        metric_count('backoffs_total', 1, {'tablo':IPADDR, 'reason':'error'})
+    elif state['usual'] is not None and SECONDS > 2 * state['usual']:
+        if now - state['cut'] > state['usual']:
+            state['window'] = max(1.0, state['window'] * 0.75)
+            state['cut'] = now
+            metric_count('backoffs_total', 1, {'tablo':IPADDR, 'reason':'latency'})
+    else:
+        state['window'] = min(float(WORKERS), state['window'] + 1.0 / state['window'])
+    if OK:
+        if state['usual'] is None or SECONDS < state['usual']:
+            state['usual'] = SECONDS
+        else:
+            state['usual'] = state['usual'] * 0.95 + SECONDS * 0.05
+    CONGESTION_LOCK.notifyAll()
+    CONGESTION_LOCK.release()
+
+#################################################################################################
+# The tablo serves /pvr and /pvr/VIDEOID/segs as directory listings, one table row per entry:
+# <tr><td class="n"><a href="00001.ts">00001.ts</a></td><td class="m">2014-Oct-12 20:00:01</td>
+# <td class="s">183.6K</td><td class="t">video/mp2t</td></tr>, a directory is listed as
+# <a href="33071/">33071</a>/</td> with "- &nbsp;" as its size.  LISTING_ROW picks out the link
+# and the size of each row in a single pass.
+LISTING_ROW = re.compile('<td class="n"><a href="([0-9]+)(/|\\.ts)">[^<]*</a>/?</td>(?:<td class="m">[^<]*</td>)?(?:<td class="s">([0-9.]+)([KMGT]?)</td>)?')
+LISTING_UNITS = {'':1, 'K':1024, 'M':1024**2, 'G':1024**3, 'T':1024**4}
+
+#################################################################################################
+# Function to read a directory listing, returns [(NAME, SIZE), ..] for each numbered directory
+# (KIND '/') or segment (KIND '.ts') in the order listed, NAME is the number as listed (without
+# the / or .ts), SIZE in bytes as listed (rounded by the tablo) or None if the listing does not
+# give one
+def parse_listing(PAGE, KIND):
+    entries = []
+    for match in LISTING_ROW.finditer(PAGE):
+        name, kind, size, unit = match.groups()
+        if kind != KIND:
+            continue
+        if size is not None:
+            size = int(float(size) * LISTING_UNITS[unit])
+        entries.append((name, size))
+    return entries
+
 #################################################################################################
 # Function to get a list of video id's from a tablo - use pvr directory to get ids
-# This will retrieve the list of video ids by parsing the directory names
+# This will retrieve the list of video ids by parsing the directory names, 'digest' is a hash
+# of the whole listing so an unchanged tablo can be spotted without looking any further
 def get_list(IPADDR):
-    resp = urllib.urlopen('http://'+IPADDR+':18080/pvr').read()
-    resp = string.splitfields(resp, '\n')
-    videoids = {'ids':{}}
-    for line in resp:
-        if string.find(line, '<tr><td class="n"><a href="') == 0:
-            line = string.splitfields(line, '<tr><td class="n"><a href="')[1]
-            if line[0] != '.':
-                line = string.splitfields(line, '/')[0]
-                videoids['ids'][line] = IPADDR
+    resp = tablo_get(IPADDR, '/pvr')
+    videoids = {'ids':{}, 'digest':hashlib.md5(resp).hexdigest()}
+    for VIDEOID, size in parse_listing(resp, '/'):
+        videoids['ids'][VIDEOID] = IPADDR
     return videoids
 
+#################################################################################################
+# Function to turn the JSON strings of VALUE (unicode) back into the utf-8 strs used everywhere else
+def meta_str(VALUE):
+    if type(VALUE) == type(u''):
+        return VALUE.encode('utf-8')
+    if type(VALUE) == type([]):
+        return [meta_str(item) for item in VALUE]
+    if type(VALUE) == type({}):
+        return dict([(meta_str(key), meta_str(item)) for key, item in VALUE.items()])
+    return VALUE
+
+#################################################################################################
+# Function to read the text of a meta.txt, which is JSON (or a python literal), None if it is
+# neither or not a dictionary
+def meta_parse(TEXT):
+    try:
+        metadata = meta_str(json.loads(TEXT))
+    except:
+        try:
+            metadata = ast.literal_eval(string.strip(TEXT))
+        except:
+            return None
+    if type(metadata) != type({}):
+        return None
+    return metadata
+
 #################################################################################################
 # Function to get a metadata from a videoid from a specific tablo
-def get_meta(IPADDR, VIDEOID):
+# CACHE is the 'cache' entry of a previous result, the request is then made conditional on the
+# ETag/Last-Modified the tablo sent, and None is returned if the metadata has not changed.
+# None is also returned if the tablo could not be asked or sent something unreadable.
+def get_meta(IPADDR, VIDEOID, CACHE=None):
+    headers = {}
+    if CACHE:
+        if CACHE.has_key('etag'):
+            headers['If-None-Match'] = CACHE['etag']
+        if CACHE.has_key('modified'):
+            headers['If-Modified-Since'] = CACHE['modified']
     try:
-        resp = urllib2.urlopen('http://'+IPADDR+':18080/pvr/'+str(VIDEOID)+'/meta.txt').read()
+        status, info, metadata = tablo_request(IPADDR, '/pvr/'+str(VIDEOID)+'/meta.txt', 'GET', headers)
     except:
-        resp= []
-    metadata = ''
-    for i in range(len(resp)):
-        metadata = metadata + resp[i]
-    metadata = eval(metadata)
+        return None
+    if status < 200 or status > 299:
+        return None
+    digest = hashlib.md5(metadata).hexdigest()
+    if CACHE and CACHE.has_key('digest') and CACHE['digest'] == digest:
+        return None
+    metadata = meta_parse(metadata)
+    if metadata is None:
+        metric_count('meta_unreadable_total', 1, {'tablo':IPADDR})
+        return None
+    metadata['cache'] = {'digest':digest}
+    if info.has_key('etag'):
+        metadata['cache']['etag'] = info['etag']
+    if info.has_key('last-modified'):
+        metadata['cache']['modified'] = info['last-modified']
     return metadata
 
 #################################################################################################
-# Function to download and rebuild the videofile
-def get_video(IPADDR, VIDEOID, DIRECTORY, TEMPDIR, FFMPEG, FILENAME, DEBUG, TESTING, *ts):
-    resp = urllib.urlopen('http://'+IPADDR+':18080/pvr/'+str(VIDEOID)+'/segs').read()
-    final = string.splitfields(resp, '.ts')[:-1]
-    final = string.splitfields(final[-1], '>')[-1]
-    tmp = final
-    while(tmp[0]) == '0':
-        tmp = tmp[1:]
-    final_int = eval(tmp)
-    #temp_id = str(uuid.uuid4())+'-'
+# Function to check a segment is whole MPEG-TS, it must be as long as the tablo said it would
+# be and made of 188 byte packets that each start with the 0x47 sync byte, raises IOError if not
+TS_PACKET = 188
+def check_segment(DATA, HEADERS):
+    if HEADERS.has_key('content-length') and len(DATA) != int(HEADERS['content-length']):
+        raise IOError('segment is '+str(len(DATA))+' bytes, expected '+HEADERS['content-length'])
+    if len(DATA) == 0 or len(DATA) % TS_PACKET:
+        raise IOError('segment of '+str(len(DATA))+' bytes is not whole MPEG-TS packets')
+    if DATA[::TS_PACKET] != '\x47' * (len(DATA) / TS_PACKET):
+        raise IOError('segment has lost MPEG-TS sync')
+
+#################################################################################################
+# Function to download a single segment, retrying with a growing delay if the tablo fails
+# or sends something that is not a valid segment (see check_segment), any other error is raised
+# straight away.
+# Fetches wait for room in the tablo's congestion window and are paced by the bandwidth caps.
+def get_segment(IPADDR, VIDEOID, SEGMENT, RETRIES, DEBUG, WORKERS=1):
+    cmd = '/pvr/'+str(VIDEOID)+'/segs/'+string.zfill(SEGMENT,5)+'.ts'
+    delay = 1.0
+    attempt = 0
+    while 1:
+        congestion_enter(IPADDR, WORKERS)
+        start = time.time()
+        try:
+            status, headers, data = tablo_request(IPADDR, cmd)
+            if status < 200 or status > 299:
+                raise IOError('HTTP '+str(status)+' retrieving http://'+IPADDR+':'+str(TABLO_PORT)+cmd)
+            try:
+                check_segment(data, headers)
+            except IOError:
+                metric_count('segment_invalid_total', 1, {'tablo':IPADDR})
+                raise IOError(str(sys.exc_info()[1])+', retrieving http://'+IPADDR+':'+str(TABLO_PORT)+cmd)
+            congestion_leave(IPADDR, WORKERS, time.time()-start, 1)
+            metric_count('segments_total', 1, {'tablo':IPADDR})
+            rate_take(IPADDR, len(data))
+            return data
+        except (IOError, socket.error, httplib.HTTPException):
+            congestion_leave(IPADDR, WORKERS, time.time()-start, 0)
+            attempt = attempt + 1
+            metric_count('segment_errors_total', 1, {'tablo':IPADDR})
+            if attempt > RETRIES:
+                raise
+            metric_count('segment_retries_total', 1, {'tablo':IPADDR})
+            if DEBUG: print '   - Retrying '+cmd+' in '+str(delay)+'s'
+            time.sleep(delay)
+            delay = delay * 2
+        except:
+            congestion_leave(IPADDR, WORKERS, time.time()-start, 0)
+            raise
+
+#################################################################################################
+# Function to download a list of segments with a pool of WORKERS threads.  Segments may arrive
+# in any order, WRITER(SEGMENT, DATA) is always called in list order from the calling thread.
+# Workers stop fetching ahead once INFLIGHT bytes are waiting to be written.
+def get_segments(IPADDR, VIDEOID, SEGMENTS, WRITER, WORKERS, RETRIES, INFLIGHT, DEBUG):
+    jobs = Queue.Queue()
+    for index in range(len(SEGMENTS)):
+        jobs.put(index)
+    state = {'next':0, 'bytes':0, 'results':{}, 'abort':0}
+    cond = threading.Condition()
+    def worker():
+        while 1:
+            try:
+                index = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            cond.acquire()
+            while state['bytes'] >= INFLIGHT and index != state['next'] and not state['abort']:
+                cond.wait()
+            abort = state['abort']
+            cond.release()
+            if abort:
+                return
+            try:
+                result = (1, get_segment(IPADDR, VIDEOID, SEGMENTS[index], RETRIES, DEBUG, WORKERS))
+            except:
+                result = (0, sys.exc_info())
+            cond.acquire()
+            state['results'][index] = result
+            if result[0]:
+                state['bytes'] = state['bytes'] + len(result[1])
+            cond.notifyAll()
+            cond.release()
+    threads = []
+    for i in range(max(1, min(WORKERS, len(SEGMENTS)))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(1)
+        t.start()
+        threads.append(t)
+    start = time.time()
+    received = 0
+    try:
+        for index in range(len(SEGMENTS)):
+            cond.acquire()
+            while not state['results'].has_key(index):
+                cond.wait(1.0)
+            result = state['results'][index]
+            del(state['results'][index])
+            cond.release()
+            if not result[0]:
+                raise result[1][0], result[1][1], result[1][2]
+            WRITER(SEGMENTS[index], result[1])
+            received = received + len(result[1])
+            cond.acquire()
+            state['bytes'] = state['bytes'] - len(result[1])
+            state['next'] = index + 1
+            cond.notifyAll()
+            cond.release()
+    finally:
+        cond.acquire()
+        state['abort'] = 1
+        cond.notifyAll()
+        cond.release()
+    elapsed = max(time.time()-start, 0.000001)
+    if SEGMENTS:
+        metric_time('transfer_seconds', elapsed, {'tablo':IPADDR}, {'video':str(VIDEOID), 'segments':len(SEGMENTS), 'bytes':received,
+                    'segments_per_s':round(len(SEGMENTS)/elapsed, 2), 'mb_per_s':round(received/1048576.0/elapsed, 2)})
+    return len(SEGMENTS)
+
+#################################################################################################
+# Function to build the ffmpeg command line that rebuilds SOURCE into DIRECTORY/FILENAME
+def ffmpeg_cmd(FFMPEG, SOURCE, DIRECTORY, FILENAME, TS):
+    if TS:
+        return [FFMPEG, '-y', '-loglevel', 'panic', '-f', 'mpegts', '-i', SOURCE, '-c', 'copy', DIRECTORY+'/'+FILENAME+'.ts']
+    return [FFMPEG, '-y', '-f', 'mpegts', '-i', SOURCE, '-bsf:a', 'aac_adtstoasc', '-c', 'copy', DIRECTORY+'/'+FILENAME+'.mp4']
+
+#################################################################################################
+# Function to read the checkpoint file of a staged download, returns {SEGMENT: SIZE} for each
+# segment that was recorded as written and is still in TEMPDIR with that same size
+def get_checkpoint(CHECKPOINT, PREFIX):
+    done = {}
+    try:
+        lines = open(CHECKPOINT).readlines()
+    except:
+        return done
+    for line in lines:
+        fields = string.split(line)
+        if len(fields) != 2 or line[-1] != '\n':
+            continue
+        try:
+            if os.path.getsize(PREFIX+fields[0]+'.ts') == int(fields[1]):
+                done[int(fields[0])] = int(fields[1])
+        except:
+            ohwell = 1
+    return done
+
+#################################################################################################
+# Function to list the segments a tablo has for a video, returns [(SEGMENT, SIZE), ..] in
+# segment order (see parse_listing)
+def get_segs(IPADDR, VIDEOID):
+    segs = [(int(SEGMENT), size) for SEGMENT, size in parse_listing(tablo_get(IPADDR, '/pvr/'+str(VIDEOID)+'/segs'), '.ts')]
+    segs.sort()
+    return segs
+
+#################################################################################################
+# Disk space taken by transfers still under way, SPACE = {device: bytes reserved}.  A transfer
+# reserves what its staged segments, the remuxed .mp4 and the HandBrake .mkv are expected to
+# take before it starts (see space_reserve) and gives it back as each is done with, at least
+# SPACE_MARGIN bytes are always left free on every disk.
+SPACE = {}
+SPACE_LOCK = threading.Condition()
+SPACE_MARGIN = 1024*1024*1024
+
+#################################################################################################
+# Function to return the bytes free for this user on the disk holding PATH
+def space_free(PATH):
+    stat = os.statvfs(PATH)
+    return stat.f_bavail * stat.f_frsize
+
+#################################################################################################
+# Function to work out the space a transfer needs, from the segment sizes the tablo lists
+# (SEGS from get_segs), returns [(PATH, BYTES, TAG), ..] for space_reserve.  Segments already
+# staged according to the checkpoint are not counted again.  With STREAM nothing is staged,
+# unless there is a checkpoint to resume from, as in fetch_video.
+def space_needed(SEGS, VIDEOID, TEMPDIR, DIRECTORY, STREAM, HANDBRAKE):
+    total = 0
+    missing = 0
+    checkpoint = TEMPDIR+'/'+str(VIDEOID)+'.progress'
+    done = get_checkpoint(checkpoint, TEMPDIR+'/'+str(VIDEOID)+'-')
+    for SEGMENT, size in SEGS:
+        total = total + (size or 0)
+        if not done.has_key(SEGMENT):
+            missing = missing + (size or 0)
+    needs = [(DIRECTORY, total, 'mp4')]
+    if not STREAM or os.path.exists(checkpoint):
+        needs.append((TEMPDIR, missing, 'temp'))
+    if HANDBRAKE:
+        needs.append((DIRECTORY, total, 'mkv'))
+    return needs
+
+#################################################################################################
+# Function to reserve the space NEEDS ([(PATH, BYTES, TAG), ..]) for a transfer, returns the
+# reservation for space_release.  If it does not fit, it waits for other transfers to give
+# their space back, with nothing else holding space it is not going to fit and None is returned.
+def space_reserve(NEEDS):
+    SPACE_LOCK.acquire()
+    try:
+        while 1:
+            wanted = {}
+            paths = {}
+            reservation = []
+            for PATH, BYTES, TAG in NEEDS:
+                device = os.stat(PATH).st_dev
+                wanted[device] = wanted.get(device, 0) + BYTES
+                paths[device] = PATH
+                reservation.append((device, BYTES, TAG))
+            fits = 1
+            for device in wanted.keys():
+                if space_free(paths[device]) - SPACE.get(device, 0) - wanted[device] < SPACE_MARGIN:
+                    fits = 0
+            if fits:
+                for device, BYTES, TAG in reservation:
+                    SPACE[device] = SPACE.get(device, 0) + BYTES
+                return reservation
+            if [device for device in wanted.keys() if SPACE.get(device, 0) > 0] == []:
+                metric_count('space_deferred_total')
+                return None
+            SPACE_LOCK.wait(60.0)
+    finally:
+        SPACE_LOCK.release()
+
+#################################################################################################
+# Function to give back the space of a reservation, only the parts tagged TAG if one is given
+def space_release(RESERVATION, TAG=None):
+    if not RESERVATION:
+        return
+    SPACE_LOCK.acquire()
+    for item in RESERVATION[:]:
+        device, BYTES, tag = item
+        if TAG is None or tag == TAG:
+            SPACE[device] = SPACE[device] - BYTES
+            RESERVATION.remove(item)
+    SPACE_LOCK.notifyAll()
+    SPACE_LOCK.release()
+
+#################################################################################################
+# Function to remove segments (VIDEOID-NNNNN.ts) left in TEMPDIR by a run that never finished,
+# those of a video with a checkpoint (VIDEOID.progress) are kept to be resumed unless, given DB,
+# the video is no longer on any tablo or has already been transfered, then the checkpoint goes
+# too.  Returns the number of files and bytes removed.
+def space_clean(TEMPDIR, DEBUG, DB=None):
+    removed, freed = 0, 0
+    names = os.listdir(TEMPDIR)
+    keep = {}
+    for name in names:
+        match = re.match('^([0-9]+)\\.progress$', name)
+        if match is None:
+            continue
+        keep[match.group(1)] = 1
+        if DB is None:
+            continue
+        wanted = 0
+        for IP in DB.keys():
+            if IP != 'config' and DB[IP].has_key(match.group(1)) and DB[IP][match.group(1)]['transfered'] != 'complete':
+                wanted = 1
+        if not wanted:
+            del(keep[match.group(1)])
+            try:
+                size = os.path.getsize(TEMPDIR+'/'+name)
+                os.remove(TEMPDIR+'/'+name)
+                removed, freed = removed + 1, freed + size
+            except:
+                ohwell = 1
+    for name in names:
+        match = re.match('^([0-9]+)-[0-9]{5}\\.ts$', name)
+        if match is None or keep.has_key(match.group(1)):
+            continue
+        try:
+            size = os.path.getsize(TEMPDIR+'/'+name)
+            os.remove(TEMPDIR+'/'+name)
+            removed, freed = removed + 1, freed + size
+        except:
+            ohwell = 1
+    if DEBUG and removed: print ' - Removed '+str(removed)+' orphaned file(s) from '+TEMPDIR+', '+str(freed/1048576)+'MB'
+    return removed, freed
+
+#################################################################################################
+# Staged downloads of the same video (a followed recording and its final transfer) take turns
+STAGE_LOCKS = {}
+STAGE_LOCK = threading.Lock()
+
+#################################################################################################
+# Function to download SEGMENTS of a video into TEMPDIR, checkpointed in TEMPDIR/VIDEOID.progress
+# so that only the segments that are missing (or the wrong size) are fetched, PROGRESS(DONE,
+# TOTAL) is called after each one, FINAL is the last segment, used for the percentage shown.
+def stage_segments(IPADDR, VIDEOID, SEGMENTS, FINAL, TEMPDIR, DEBUG, WORKERS, RETRIES, INFLIGHT, PROGRESS):
     temp_id = str(VIDEOID)+'-'
-    counter = 1
-    valid = 1
+    checkpoint = TEMPDIR+'/'+str(VIDEOID)+'.progress'
+    STAGE_LOCK.acquire()
+    if not STAGE_LOCKS.has_key(checkpoint):
+        STAGE_LOCKS[checkpoint] = threading.Lock()
+    lock = STAGE_LOCKS[checkpoint]
+    STAGE_LOCK.release()
+    lock.acquire()
+    try:
+        done = get_checkpoint(checkpoint, TEMPDIR+'/'+temp_id)
+        missing = []
+        for counter in SEGMENTS:
+            if not done.has_key(counter):
+                missing.append(counter)
+        if DEBUG and missing != [] and len(missing) < len(SEGMENTS): print '   - Resuming, '+str(len(SEGMENTS)-len(missing))+' segment(s) already retrieved'
+        count = [len(SEGMENTS)-len(missing)]
+        log = open(checkpoint, 'a')
+        def writer(SEGMENT, DATA):
+            if DEBUG: print '   - Retrieved segment '+string.zfill(SEGMENT,5)+' ('+str(int(float(SEGMENT)/float(FINAL)*100.0))+'%)'
+            tmp = open(TEMPDIR+'/'+temp_id+string.zfill(SEGMENT,5)+'.ts', 'wb')
+            tmp.write(DATA)
+            tmp.close()
+            log.write(string.zfill(SEGMENT,5)+' '+str(len(DATA))+'\n')
+            log.flush()
+            count[0] = count[0] + 1
+            if PROGRESS: PROGRESS(count[0], len(SEGMENTS))
+        try:
+            get_segments(IPADDR, VIDEOID, missing, writer, WORKERS, RETRIES, INFLIGHT, DEBUG)
+        finally:
+            log.close()
+    finally:
+        lock.release()
+    return len(missing)
+
+#################################################################################################
+# Function to download the segments of a video, with STREAM set the segments are piped
+# straight into ffmpeg as they arrive instead of being staged in TEMPDIR (see stage_segments)
+# Returns the staged segments for remux_video, or None if the video was already streamed.
+# SEGS is the segment listing if it has already been fetched (see get_segs).  If streaming
+# fails, in ffmpeg or fetching a segment, the partial file is removed and the error raised.
+def fetch_video(IPADDR, VIDEOID, DIRECTORY, TEMPDIR, FFMPEG, FILENAME, DEBUG, TESTING, WORKERS=4, RETRIES=3, INFLIGHT=64*1024*1024, TS=0, STREAM=0, PROGRESS=None, SEGS=None):
+    if SEGS is None:
+        SEGS = get_segs(IPADDR, VIDEOID)
+    segments = []
+    for SEGMENT, size in SEGS:
+        segments.append(SEGMENT)
+    if segments == []:
+        raise IOError('no segments listed for video '+str(VIDEOID)+' on '+IPADDR)
+    final_int = segments[-1]
+    if TESTING:
+        segments = segments[:5] ## Only process first 5 segmant
+    checkpoint = TEMPDIR+'/'+str(VIDEOID)+'.progress'
+    if STREAM and not os.path.exists(checkpoint):
+        cmd = ffmpeg_cmd(FFMPEG, 'pipe:0', DIRECTORY, FILENAME, TS)
+        if DEBUG: print string.join(cmd, ' ')
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        def writer(SEGMENT, DATA):
+            if DEBUG: print '   - Streaming segment '+string.zfill(SEGMENT,5)+' ('+str(int(float(SEGMENT)/float(final_int)*100.0))+'%)'
+            proc.stdin.write(DATA)
+        error = None
+        try:
+            get_segments(IPADDR, VIDEOID, segments, writer, WORKERS, RETRIES, INFLIGHT, DEBUG)
+        except:
+            error = sys.exc_info()
+        try:
+            proc.stdin.close()
+        except:
+            ohwell = 1
+        status = proc.wait()
+        metric_time('ffmpeg_seconds', time.time()-start, {}, {'video':str(VIDEOID), 'stream':1})
+        if status != 0 or error is not None:
+            # nothing is staged to try again from, so do not leave a half written file
+            output = DIRECTORY+'/'+FILENAME+'.mp4'
+            if TS:
+                output = DIRECTORY+'/'+FILENAME+'.ts'
+            try:
+                os.remove(output)
+            except:
+                ohwell = 1
+            if status != 0:
+                raise IOError('ffmpeg failed ('+str(status)+') streaming '+FILENAME)
+            raise error[0], error[1], error[2]
+        return None
+    stage_segments(IPADDR, VIDEOID, segments, final_int, TEMPDIR, DEBUG, WORKERS, RETRIES, INFLIGHT, PROGRESS)
+    return segments
+
+#################################################################################################
+# Function to follow a video that is still recording, the segments the tablo has finished
+# writing (all but the last) are staged in TEMPDIR every POLL seconds until the recording is
+# over, so fetch_video only has the tail left to get.  With POLL at 0 only one pass is made.
+# Each pass reserves the temp space it is going to write (see space_reserve), a pass that does
+# not fit is skipped.  Returns the recording status last seen.
+def follow_video(IPADDR, VIDEOID, TEMPDIR, DEBUG, TESTING, WORKERS=4, RETRIES=3, INFLIGHT=64*1024*1024, POLL=60):
+    while 1:
+        meta = get_meta(IPADDR, VIDEOID)
+        if meta is None:
+            raise IOError('could not read the metadata of video '+str(VIDEOID)+' on '+IPADDR)
+        status = proc_meta(meta)['status']
+        if status == 'finished':
+            return status
+        segs = get_segs(IPADDR, VIDEOID)[:-1]
+        if TESTING:
+            segs = segs[:5] ## Only process first 5 segmant
+        segments = []
+        for SEGMENT, size in segs:
+            segments.append(SEGMENT)
+        space = space_reserve([need for need in space_needed(segs, VIDEOID, TEMPDIR, TEMPDIR, 0, 0) if need[2] == 'temp'])
+        if space is None:
+            if DEBUG: print '   - Following '+str(VIDEOID)+', not enough disk space in '+TEMPDIR+', waiting'
+        else:
+            try:
+                fetched = stage_segments(IPADDR, VIDEOID, segments, len(segments)+1, TEMPDIR, DEBUG, WORKERS, RETRIES, INFLIGHT, None)
+            finally:
+                space_release(space)
+            if DEBUG: print '   - Following '+str(VIDEOID)+', '+str(fetched)+' new segment(s), '+str(len(segments))+' staged'
+        if POLL <= 0:
+            return status
+        time.sleep(POLL)
+
+#################################################################################################
+# Function to rebuild the staged SEGMENTS of a video into DIRECTORY/FILENAME and clean up TEMPDIR
+# If ffmpeg fails the segments are left for another try and IOError is raised
+def remux_video(VIDEOID, SEGMENTS, DIRECTORY, TEMPDIR, FFMPEG, FILENAME, DEBUG, TS=0):
+    if SEGMENTS is None:
+        return 0
+    temp_id = str(VIDEOID)+'-'
+    checkpoint = TEMPDIR+'/'+str(VIDEOID)+'.progress'
     concat = ''
-    while valid:
-        cmd = 'http://'+IPADDR+':18080/pvr/'+str(VIDEOID)+'/segs/'+string.zfill(counter,5)+'.ts'
-        newfile = TEMPDIR+'/'+temp_id+string.zfill(counter,5)+'.ts'
-        concat = concat + newfile+'|'
-        if DEBUG: print '   - Retrieving '+cmd+ ' ('+str(int(float(counter)/float(final_int)*100.0))+'%)'
-        urllib.urlretrieve(cmd, newfile)
-        if string.zfill(counter,5) == final:
-            valid = 0
-        counter = counter + 1
-        if TESTING and counter > 5:
-            valid = 0 ## Only process first 5 segmant
-    cmd = FFMPEG+' -y -i "concat:'+concat[:-1]+'" -bsf:a aac_adtstoasc -c copy "'+DIRECTORY+'/'+FILENAME+'.mp4"'
-    if ts:
-        cmd = FFMPEG+' -y -loglevel panic -i "concat:'+concat[:-1]+'" -c copy "'+DIRECTORY+'/'+FILENAME+'.ts"'
-    if DEBUG: print cmd
+    for counter in SEGMENTS:
+        concat = concat + TEMPDIR+'/'+temp_id+string.zfill(counter,5)+'.ts'+'|'
+    cmd = ffmpeg_cmd(FFMPEG, 'concat:'+concat[:-1], DIRECTORY, FILENAME, TS)
+    if DEBUG: print string.join(cmd, ' ')
     #os.system(cmd)
-    subprocess.call(cmd)
-    counter = 1
-    valid = 1
-    while valid:
+    start = time.time()
+    status = subprocess.call(cmd)
+    metric_time('ffmpeg_seconds', time.time()-start, {}, {'video':str(VIDEOID), 'stream':0})
+    if status != 0:
+        # keep the segments to try again, but not a half written file
+        try:
+            os.remove(DIRECTORY+'/'+FILENAME+'.mp4')
+        except:
+            ohwell = 1
+        raise IOError('ffmpeg failed ('+str(status)+') rebuilding '+FILENAME)
+    for counter in SEGMENTS:
         newfile = TEMPDIR+'/'+temp_id+string.zfill(counter,5)+'.ts'
         try:
             os.remove(newfile)
         except:
             ohwell = 1
             if DEBUG: print "Can't Delete " + newfile
-        if string.zfill(counter,5) == final:
-            valid = 0
-        counter = counter + 1
+    try:
+        os.remove(checkpoint)
+    except:
+        ohwell = 1
+    return 0
+
+#################################################################################################
+# Function to download and rebuild the videofile
+def get_video(IPADDR, VIDEOID, DIRECTORY, TEMPDIR, FFMPEG, FILENAME, DEBUG, TESTING, WORKERS=4, RETRIES=3, INFLIGHT=64*1024*1024, TS=0, STREAM=0, PROGRESS=None):
+    segments = fetch_video(IPADDR, VIDEOID, DIRECTORY, TEMPDIR, FFMPEG, FILENAME, DEBUG, TESTING, WORKERS, RETRIES, INFLIGHT, TS, STREAM, PROGRESS)
+    return remux_video(VIDEOID, segments, DIRECTORY, TEMPDIR, FFMPEG, FILENAME, DEBUG, TS)
+
+#################################################################################################
+# Function to post process DIRECTORY/FILENAME.mp4 with handbrake, the mp4 is deleted afterwards
+# if handbrake succeeded, otherwise the partial mkv is and IOError is raised
+def transcode_video(DIRECTORY, FILENAME, DEBUG):
+    cmd = 'HandBrakeCLI -i "'+DIRECTORY+'/'+FILENAME+'.mp4" -f -a 1 -E copy -f mkv -O -e x264 -q 22.0 --loose-anamorphic --modulus 2 -m --x264-preset medium --h264-profile high --h264-level 4.1 --decomb --denoise=weak -v -o "'+DIRECTORY+'/'+FILENAME+'.mkv"'
+    if DEBUG: print cmd
+    start = time.time()
+    status = os.system(cmd)
+    metric_time('handbrake_seconds', time.time()-start, {}, {'file':FILENAME})
+    if status != 0:
+        # a full disk leaves a partial .mkv behind, the .mp4 is kept for another try
+        try:
+            os.remove(DIRECTORY+'/'+FILENAME+'.mkv')
+        except:
+            ohwell = 1
+        raise IOError('HandBrakeCLI failed ('+str(status)+') on '+FILENAME)
+    try:
+        os.remove(DIRECTORY+'/'+FILENAME+'.mp4')
+    except:
+        ohwell = 1
     return 0
 
+#################################################################################################
+# Jobs waiting for the first stage of a pipeline.  Jobs can be added (job_add) while the pipeline
+# runs, which waits for more until job_close is called.  A job is added under KEYS and is not
+# added again while one of them belongs to a job that is waiting or still in the pipeline.
+# SORT(JOBS) puts the waiting jobs back in order each time one is added.
+def job_queue(JOBS=[], SORT=None, OPEN=1):
+    return {'jobs':list(JOBS), 'keys':{}, 'added':len(JOBS), 'open':OPEN, 'sort':SORT, 'ready':threading.Condition()}
+
+#################################################################################################
+# Function to check if any of KEYS is already waiting or in the pipeline
+def job_queued(QUEUE, KEYS):
+    QUEUE['ready'].acquire()
+    try:
+        for KEY in KEYS:
+            if QUEUE['keys'].has_key(KEY):
+                return 1
+        return 0
+    finally:
+        QUEUE['ready'].release()
+
+#################################################################################################
+# Function to add JOB to QUEUE under KEYS, returns 0 if one of KEYS is already there
+def job_add(QUEUE, KEYS, JOB):
+    QUEUE['ready'].acquire()
+    try:
+        for KEY in KEYS:
+            if QUEUE['keys'].has_key(KEY):
+                return 0
+        for KEY in KEYS:
+            QUEUE['keys'][KEY] = JOB
+        QUEUE['jobs'].append(JOB)
+        QUEUE['added'] = QUEUE['added'] + 1
+        if QUEUE['sort'] is not None:
+            QUEUE['sort'](QUEUE['jobs'])
+        QUEUE['ready'].notifyAll()
+        return 1
+    finally:
+        QUEUE['ready'].release()
+
+#################################################################################################
+# Function to let the pipeline of QUEUE finish once the jobs already added are done
+def job_close(QUEUE):
+    QUEUE['ready'].acquire()
+    QUEUE['open'] = 0
+    QUEUE['ready'].notifyAll()
+    QUEUE['ready'].release()
+
+#################################################################################################
+# Function to free the keys of a job that has left the pipeline
+def job_done(QUEUE, JOB):
+    QUEUE['ready'].acquire()
+    for KEY, job in QUEUE['keys'].items():
+        if job is JOB:
+            del(QUEUE['keys'][KEY])
+    QUEUE['ready'].release()
+
+#################################################################################################
+# Function to run JOBS through a series of STAGES, [(FUNC, WORKERS), ...], each stage has its
+# own pool of worker threads and hands jobs on through a queue holding at most DEPTH jobs, so
+# the next download can run while an earlier job is still being remuxed or transcoded.
+# ON_STAGE(STAGE, JOB, ERROR) is called from the calling thread as each job clears a stage,
+# ERROR is the sys.exc_info() of a failed stage, and that job goes no further.
+# The first stage takes JOBS in order, with LIMIT, (KEY, N), it skips over a job while N jobs
+# with the same KEY(JOB) are already in the first stage (e.g. N downloads from each tablo).
+# JOBS is a list, or a job_queue that more jobs can be added to, the pipeline then returns
+# once the queue has been closed (job_close) and everything added is done.
+def pipeline(JOBS, STAGES, DEPTH, ON_STAGE, LIMIT=None):
+    if type(JOBS) == type([]):
+        JOBS = job_queue(JOBS, OPEN=0)
+    queues = [None]
+    for i in range(1, len(STAGES)):
+        queues.append(Queue.Queue(max(1, DEPTH)))
+    events = Queue.Queue()
+    running = [STAGES[i][1] for i in range(len(STAGES))]
+    lock = threading.Lock()
+    pending = JOBS['jobs']
+    busy = {}
+    ready = JOBS['ready']
+    def key(JOB):
+        if LIMIT is None:
+            return None
+        return LIMIT[0](JOB)
+    def take():
+        ready.acquire()
+        try:
+            while pending != [] or JOBS['open']:
+                for i in range(len(pending)):
+                    if LIMIT is None or busy.get(key(pending[i]), 0) < LIMIT[1]:
+                        busy[key(pending[i])] = busy.get(key(pending[i]), 0) + 1
+                        return pending.pop(i)
+                ready.wait(1.0)
+            return None
+        finally:
+            ready.release()
+    def worker(STAGE):
+        while 1:
+            if STAGE == 0:
+                job = take()
+            else:
+                job = queues[STAGE].get()
+            if job is None:
+                break
+            try:
+                try:
+                    STAGES[STAGE][0](job)
+                finally:
+                    if STAGE == 0:
+                        ready.acquire()
+                        busy[key(job)] = busy[key(job)] - 1
+                        ready.notifyAll()
+                        ready.release()
+            except:
+                events.put((STAGE, job, sys.exc_info()))
+                continue
+            events.put((STAGE, job, None))
+            if STAGE+1 < len(STAGES):
+                queues[STAGE+1].put(job)
+        lock.acquire()
+        running[STAGE] = running[STAGE] - 1
+        last = running[STAGE] == 0
+        lock.release()
+        if last and STAGE+1 < len(STAGES):
+            for i in range(STAGES[STAGE+1][1]):
+                queues[STAGE+1].put(None)
+    for STAGE in range(len(STAGES)):
+        for i in range(STAGES[STAGE][1]):
+            t = threading.Thread(target=worker, args=(STAGE,))
+            t.setDaemon(1)
+            t.start()
+    finished = 0
+    while JOBS['open'] or finished < JOBS['added']:
+        try:
+            STAGE, job, error = events.get(True, 1.0)
+        except Queue.Empty:
+            continue
+        ON_STAGE(STAGE, job, error)
+        if error is not None or STAGE == len(STAGES)-1:
+            finished = finished + 1
+            job_done(JOBS, job)
+    return finished
+
+#################################################################################################
+# Function to put JOBS (see __main__) in the order they should be downloaded, ORDER is
+# 'watch' (by watchlist rule, then tablo), 'newest' (most recently recorded first) or
+# 'shortest' (smallest first, from the segment listings, which are kept in the jobs)
+def order_jobs(JOBS, ORDER, TABLOS, WORKERS=8):
+    def listing(JOB):
+        try:
+            JOB['segs'] = get_segs(JOB['item'][0], JOB['item'][1])
+        except:
+            JOB['segs'] = None
+    if ORDER == 'shortest':
+        thread_map(listing, [JOB for JOB in JOBS if JOB['segs'] is None], WORKERS)
+    return order_sort(JOBS, ORDER, TABLOS)
+
+#################################################################################################
+# Function to sort JOBS by ORDER (see order_jobs) from what the jobs already hold
+def order_sort(JOBS, ORDER, TABLOS):
+    def recorded(JOB):
+        PROC = JOB['item'][5]
+        if PROC['type'] == 'movie':
+            return str(PROC['airdate'])
+        return str(PROC['date'])
+    def size(JOB):
+        if JOB['segs'] is None:
+            return (1, 0)
+        return (0, sum([BYTES or 0 for SEGMENT, BYTES in JOB['segs']]))
+    if ORDER == 'newest':
+        JOBS.sort(key=recorded, reverse=True)
+    elif ORDER == 'shortest':
+        JOBS.sort(key=size)
+    else:
+        JOBS.sort(key=lambda JOB: (JOB['rank'], TABLOS.index(JOB['item'][0])))
+    return JOBS
+
 #################################################################################################
 # Function to look at a dictionary
 def print_dictionary(DICT, *LEVEL):
@@ -168,27 +1158,64 @@ def clean(VALUE):
     return results
 
 #################################################################################################
-# Get a value from a dictionary via an input like "a.b.c.d.e"
+# Get a value from a dictionary via an input like "a.b.c.d.e", each path is only split the
+# first time it is seen and kept in VALUE_PATHS
+VALUE_PATHS = {}
 def get_value(DICT, VKEYS, DEFAULT):
-    if str(type(DICT)) != "<type 'dict'>":
-        return DEFAULT
-    key_top = string.splitfields(VKEYS, '.')[0]
-    if not DICT.has_key(key_top):
-        return DEFAULT
-    key_bottom = ''
-    key_index = string.find(VKEYS, '.')
-    if key_index != -1:
-        key_bottom = VKEYS[key_index+1:]
-    if key_bottom == '':
-        return DICT[key_top]
-    else:
-        return get_value(DICT[key_top], key_bottom, DEFAULT)
+    path = VALUE_PATHS.get(VKEYS)
+    if path is None:
+        path = VALUE_PATHS[VKEYS] = tuple(string.splitfields(VKEYS, '.'))
+    for key in path:
+        if type(DICT) is not dict or not DICT.has_key(key):
+            return DEFAULT
+        DICT = DICT[key]
+    return DICT
+
+#################################################################################################
+# A recording as it is kept in memory, the fields proc_meta takes from its metadata, how far
+# it has been transfered, when it should be done recording (get_end) and the conditional
+# request cache (get_meta).  The metadata itself is held in META only until db_save has
+# written it, after that it is read back with db_meta when needed.  Fields are read and set
+# like the dictionary this replaces, REC['status'].
+RECORDING_FIELDS = ['status', 'transfered', 'type', 'name', 'series', 'season', 'episode', 'airdate', 'title',
+                    'desc', 'date', 'clean', 'progress', 'ends', 'cache']
+class Recording(object):
+    __slots__ = RECORDING_FIELDS + ['meta']
+
+    def __init__(self, META=None, FIELDS={}):
+        for field in RECORDING_FIELDS:
+            setattr(self, field, FIELDS.get(field))
+        if self.transfered is None:
+            self.transfered = 0
+        self.meta = META
+
+    def __getitem__(self, KEY):
+        try:
+            return getattr(self, KEY)
+        except AttributeError:
+            raise KeyError(KEY)
+
+    def __setitem__(self, KEY, VALUE):
+        try:
+            setattr(self, KEY, VALUE)
+        except AttributeError:
+            raise KeyError(KEY)
+
+    def has_key(self, KEY):
+        return KEY in RECORDING_FIELDS
+
+    def __repr__(self):
+        return 'Recording('+repr(dict([(field, getattr(self, field)) for field in RECORDING_FIELDS]))+')'
 
 #################################################################################################
 # Get primary metadata fields (series name, episode name, season number, episode number, etc)
-def proc_meta(IPADDR, VIDEOID, DB):
-    PROC = {'transfered':0}
-    metadata = DB[IPADDR][VIDEOID]
+# Returns a Recording holding METADATA, the 'cache' get_meta added is moved onto the recording.
+def proc_meta(METADATA):
+    metadata = METADATA
+    PROC = Recording(metadata)
+    if metadata.has_key('cache'):
+        PROC['cache'] = metadata['cache']
+        del(metadata['cache'])
     PROC['status']   = get_value(metadata, 'recMovieAiring.jsonForClient.video.state','unknown')
     PROC['airdate']  = get_value(metadata, 'recMovieAiring.jsonForClient.airDate','')
     PROC['desc']     = get_value(metadata, 'recMovie.jsonForClient.plot', '')
@@ -214,95 +1241,720 @@ def proc_meta(IPADDR, VIDEOID, DB):
         PROC['type'] = 'movie'
         PROC['name'] = PROC['title']+ ' (' +str(PROC['date']) + ')'
     PROC['clean']    = clean(PROC['name'])
+    PROC['ends']     = get_end(metadata)
     return PROC
 
+#################################################################################################
+# Function to call FUNC on every item of ITEMS using up to WORKERS threads, the results are
+# returned in the same order as ITEMS, the first exception raised by FUNC is re-raised
+def thread_map(FUNC, ITEMS, WORKERS):
+    if WORKERS <= 1 or len(ITEMS) <= 1:
+        return map(FUNC, ITEMS)
+    results = [None] * len(ITEMS)
+    errors = []
+    jobs = Queue.Queue()
+    for index in range(len(ITEMS)):
+        jobs.put(index)
+    def worker():
+        while not errors:
+            try:
+                index = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = FUNC(ITEMS[index])
+            except:
+                errors.append(sys.exc_info())
+    threads = []
+    for i in range(min(WORKERS, len(ITEMS))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(1)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+#################################################################################################
+# Function to work out when a recording in progress should be done, from the air time and the
+# scheduled duration in its metadata, returns seconds since the epoch, 0 if it can not be told
+def get_end(METADATA):
+    aired = get_value(METADATA, 'recMovieAiring.jsonForClient.airDate', '')
+    aired = get_value(METADATA, 'recEpisode.jsonForClient.airDate', aired)
+    duration = get_value(METADATA, 'recMovieAiring.jsonForClient.duration', 0)
+    duration = get_value(METADATA, 'recEpisode.jsonForClient.duration', duration)
+    try:
+        if int(duration) > 0:
+            return calendar.timegm(time.strptime(aired[:16], '%Y-%m-%dT%H:%M')) + int(duration)
+    except:
+        ohwell = 1
+    return 0
+
+#################################################################################################
+# Function to pick the recordings in progress whose metadata is due to be checked again, CHECKED
+# holds {(IP, ID): time} of the last check.  A recording is left alone until FAST seconds before
+# its expected end, is then checked every FAST seconds for up to GRACE seconds past the end, and
+# otherwise (or if the end is not known) every SLOW seconds.  Returns the due recordings
+# ({(IP, ID): 1}) and the seconds until the next one is due (None if nothing is recording).
+def poll_due(TABLOS, DB, CHECKED, NOW, FAST, SLOW, GRACE=900):
+    due = {}
+    wait = None
+    for IP in TABLOS:
+        for ID in DB[IP].keys():
+            if DB[IP][ID]['status'] == 'finished':
+                continue
+            last = CHECKED.get((IP, ID), 0)
+            end = DB[IP][ID]['ends']
+            if end and NOW < end - FAST:
+                when = min(end - FAST, last + SLOW)
+            elif end and NOW < end + GRACE:
+                when = last + FAST
+            else:
+                when = last + SLOW
+            if when <= NOW:
+                due[(IP, ID)] = 1
+            elif wait is None or when - NOW < wait:
+                wait = when - NOW
+    return due, wait
+
 #################################################################################################
 # Loop through tablos searching for videos and update database to reflect
-def db_update(TABLOS, DB):
+# All tablos are polled at once, and up to WORKERS metadata files are fetched from each tablo
+# at a time, the database itself is only changed once everything has been retrieved.
+# A tablo whose listing is the same as last time and has nothing recording is skipped after
+# the listing, recordings still in progress are re-fetched with a conditional request and only
+# reprocessed if their metadata actually changed.  Given REFRESH ({(IP, ID): 1}) the listings
+# are left alone and only the metadata of those recordings is checked (see poll_due).
+# A tablo that cannot be reached is reported and left as it was.  When each tablo was last swept in full is kept in DB['config']['swept'] (see db_age).
+# DB is changed with DB_LOCK held, a recording that is reprocessed keeps its transfer state.
+def db_update(TABLOS, DB, WORKERS=8, REFRESH=None):
+    start = time.time()
     found_count, add_count, del_count, proc_count = 0,0,0,0
+    if not DB.has_key('config'):
+        DB['config'] = {}
+    if not DB['config'].has_key('listing'):
+        DB['config']['listing'] = {}
+    listing = DB['config']['listing']
+    if not DB['config'].has_key('swept'):
+        DB['config']['swept'] = {}
     for IP in TABLOS:
         if not DB.has_key(IP):
             DB[IP] = {}
-        videoids = get_list(IP)
-        found_count = found_count + len(videoids['ids'])
-        for ID in videoids['ids'].keys():
-            if not DB[IP].has_key(ID):
-                add_count = add_count + 1
-                DB[IP][ID] = get_meta(IP, ID)
-            elif DB[IP][ID]['proc']['status'] != 'finished':
-                del(DB[IP][ID])
-                DB[IP][ID] = get_meta(IP, ID)
-        for ID in DB[IP].keys():
-            if not videoids['ids'].has_key(ID):
-                del_count = del_count + 1
-                del(DB[IP][ID])
-        for ID in DB[IP].keys():
-            if not DB[IP][ID].has_key('proc'):
-                proc_count = proc_count + 1
-                metadata = proc_meta(IP,ID,DB)
-                DB[IP][ID]['proc'] = proc_meta(IP, ID, DB)
-            if DB[IP][ID]['proc']['status'] != 'finished':
+    def sweep(IP):
+        try:
+            start = time.time()
+            wanted = []
+            if REFRESH is not None:
+                videoids = None
+                for KEY in REFRESH.keys():
+                    if KEY[0] == IP and DB[IP].has_key(KEY[1]):
+                        wanted.append(KEY[1])
+            else:
+                videoids = get_list(IP)
+                metric_time('list_seconds', time.time()-start, {'tablo':IP}, {'recordings':len(videoids['ids'])})
+                for ID in videoids['ids'].keys():
+                    if not DB[IP].has_key(ID) or DB[IP][ID]['status'] != 'finished':
+                        wanted.append(ID)
+                if listing.has_key(IP) and listing[IP] == videoids['digest'] and wanted == []:
+                    return videoids, wanted, []
+            def fetch(ID):
+                if DB[IP].has_key(ID):
+                    return get_meta(IP, ID, DB[IP][ID]['cache'])
+                return get_meta(IP, ID)
+            start = time.time()
+            metadata = thread_map(fetch, wanted, WORKERS)
+            metric_time('meta_seconds', time.time()-start, {'tablo':IP}, {'fetched':len(wanted)})
+            return videoids, wanted, metadata
+        except:
+            # one tablo that cannot be reached is left as it was, the others are still swept
+            print ' - Could not check the tablo at '+IP+' ('+str(sys.exc_info()[1])+')'
+            metric_count('sweep_errors_total', 1, {'tablo':IP})
+            return None, [], []
+    results = thread_map(sweep, TABLOS, len(TABLOS))
+    DB_LOCK.acquire()
+    try:
+        for i in range(len(TABLOS)):
+            IP = TABLOS[i]
+            videoids, wanted, metadata = results[i]
+            if videoids is not None:
+                found_count = found_count + len(videoids['ids'])
+            for j in range(len(wanted)):
+                ID = wanted[j]
+                if metadata[j] is None:
+                    continue
+                PROC = proc_meta(metadata[j])
+                if not DB[IP].has_key(ID):
+                    add_count = add_count + 1
+                else:
+                    PROC['transfered'] = DB[IP][ID]['transfered']
+                    PROC['progress'] = DB[IP][ID]['progress']
+                    del(DB[IP][ID])
+                DB[IP][ID] = PROC
                 proc_count = proc_count + 1
-                metadata = proc_meta(IP,ID,DB)
-                DB[IP][ID]['proc'] = proc_meta(IP, ID, DB)
+                db_mark(DB, IP, ID)
+            if videoids is None or (listing.has_key(IP) and listing[IP] == videoids['digest']):
+                continue
+            for ID in DB[IP].keys():
+                if not videoids['ids'].has_key(ID):
+                    del_count = del_count + 1
+                    del(DB[IP][ID])
+                    db_mark(DB, IP, ID)
+            listing[IP] = videoids['digest']
+        if REFRESH is None:
+            for i in range(len(TABLOS)):
+                if results[i][0] is not None:
+                    DB['config']['swept'][TABLOS[i]] = start
+    finally:
+        DB_LOCK.release()
+    metric_time('sweep_seconds', time.time()-start, {}, {'found':found_count, 'added':add_count, 'deleted':del_count, 'processed':proc_count})
     return DB, found_count, add_count, del_count, proc_count
 
 #################################################################################################
-# Load database from the hard drive if already created, lets not query over and over
-def db_load(DATABASE_FILE):
+# The database is an SQLite file with one row per recording, every field of a Recording has a
+# column of its own (those searched on are indexed) and the raw metadata is kept zlib
+# compressed in the meta column.  Only recordings marked via db_mark are written by db_save.
+# The words of each name and description are kept in the terms table (see db_search).
+DB_CONN = {}
+DB_LOCK = threading.RLock()     # held to change DB while the transfer pipeline may be using it
+DB_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS recordings (ip TEXT NOT NULL, id TEXT NOT NULL, status TEXT, transferred TEXT, type TEXT, name TEXT, '
+    'series TEXT, season TEXT, episode TEXT, airdate TEXT, title TEXT, description TEXT, season_num INTEGER, episode_num INTEGER, '
+    'date TEXT, clean TEXT, progress TEXT, ends INTEGER, cache TEXT, meta BLOB, PRIMARY KEY (ip, id))',
+    'CREATE INDEX IF NOT EXISTS recordings_status ON recordings (status)',
+    'CREATE INDEX IF NOT EXISTS recordings_transferred ON recordings (transferred)',
+    'CREATE INDEX IF NOT EXISTS recordings_series ON recordings (series COLLATE NOCASE)',
+    'CREATE INDEX IF NOT EXISTS recordings_season ON recordings (season_num)',
+    'CREATE INDEX IF NOT EXISTS recordings_airdate ON recordings (airdate)',
+    'CREATE INDEX IF NOT EXISTS recordings_type ON recordings (type)',
+    'CREATE TABLE IF NOT EXISTS terms (field TEXT NOT NULL, term TEXT NOT NULL, ip TEXT NOT NULL, id TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS terms_term ON terms (field, term)',
+    'CREATE INDEX IF NOT EXISTS terms_recording ON terms (ip, id)',
+    'CREATE TABLE IF NOT EXISTS catalog (key TEXT PRIMARY KEY, ip TEXT, id TEXT, name TEXT, path TEXT, size INTEGER, md5 TEXT, added REAL)',
+    'CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)',
+]
+DB_FIELDS = ['status', 'transferred', 'type', 'name', 'series', 'season', 'episode', 'airdate', 'title', 'description', 'season_num', 'episode_num',
+             'date', 'clean', 'progress', 'ends', 'cache']
+
+#################################################################################################
+# Function to open (and create or migrate if needed) the database file
+def db_open(DATABASE_FILE):
+    if DB_CONN.has_key(DATABASE_FILE):
+        return DB_CONN[DATABASE_FILE]
+    legacy = None
+    try:
+        header = open(DATABASE_FILE, 'rb').read(16)
+    except:
+        header = ''
+    if header != '' and header != 'SQLite format 3\000':
+        # parsed before anything is touched, a file that cannot be read is left as it is
+        legacy = db_legacy(open(DATABASE_FILE).readline())
+        os.rename(DATABASE_FILE, DATABASE_FILE+'.old')
+    conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+    conn.text_factory = str
+    for statement in DB_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    DB_CONN[DATABASE_FILE] = conn
+    if legacy is not None:
+        try:
+            db_migrate(DATABASE_FILE, legacy)
+        except:
+            # put the old file back rather than leave a half imported database
+            error = sys.exc_info()
+            del(DB_CONN[DATABASE_FILE])
+            conn.close()
+            os.remove(DATABASE_FILE)
+            os.rename(DATABASE_FILE+'.old', DATABASE_FILE)
+            raise error[0], error[1], error[2]
+    return conn
+
+#################################################################################################
+# Function to read the single str(dict) line earlier versions kept the database in, raises
+# ValueError if it is not one
+def db_legacy(LINE):
+    try:
+        DB = ast.literal_eval(string.strip(LINE))
+    except:
+        raise ValueError('not an SQLite database or one from an earlier version ('+str(sys.exc_info()[1])+')')
+    if type(DB) != type({}):
+        raise ValueError('not an SQLite database or one from an earlier version')
+    return DB
+
+#################################################################################################
+# Function to import a database written by earlier versions (DB from db_legacy), the original
+# file is left beside the new one as DATABASE_FILE.old
+def db_migrate(DATABASE_FILE, DB):
+    DB['dirty'] = {}
+    for IP in DB.keys():
+        if IP in ['complete', 'config', 'dirty']:
+            continue
+        for ID in DB[IP].keys():
+            DB[IP][ID] = db_record(DB[IP][ID])
+            db_mark(DB, IP, ID)
+    db_save(DATABASE_FILE, DB)
+
+#################################################################################################
+# Function to turn the metadata dictionary kept by earlier versions (with the proc dictionary
+# inside it) into a Recording, the transfer state is carried over
+def db_record(META):
+    proc = {}
+    if META.has_key('proc'):
+        proc = META['proc']
+        del(META['proc'])
+    REC = proc_meta(META)
+    REC['transfered'] = proc.get('transfered', 0)
+    REC['progress'] = proc.get('progress')
+    return REC
+
+#################################################################################################
+# Function to split text into lower case search terms
+def search_terms(TEXT):
+    if not isinstance(TEXT, basestring):
+        TEXT = str(TEXT)
+    terms = {}
+    for term in re.findall('[a-z0-9]+', TEXT.lower()):
+        terms[term] = 1
+    return terms.keys()
+
+#################################################################################################
+# Function to get the values of the DB_FIELDS columns from a Recording
+def db_fields(PROC):
+    def number(VALUE):
+        try:
+            return int(VALUE)
+        except:
+            return None
+    cache = None
+    if PROC['cache'] is not None:
+        cache = json.dumps(PROC['cache'])
+    return (PROC['status'], str(PROC['transfered']), PROC['type'], PROC['name'], PROC['series'], str(PROC['season']),
+            str(PROC['episode']), PROC['airdate'], PROC['title'], PROC['desc'], number(PROC['season']), number(PROC['episode']),
+            str(PROC['date']), PROC['clean'], PROC['progress'], PROC['ends'], cache)
+
+#################################################################################################
+# Function to compress metadata for the meta column, and db_unpack to read it back
+def db_pack(META):
+    return sqlite3.Binary(zlib.compress(repr(META)))
+
+def db_unpack(VALUE):
+    return ast.literal_eval(zlib.decompress(str(VALUE)))
+
+#################################################################################################
+# Function to replace the search terms of a recording, a PROC of None just removes them
+def db_index(CONN, IP, ID, PROC):
+    CONN.execute('DELETE FROM terms WHERE ip = ? AND id = ?', (IP, ID))
+    if PROC is None:
+        return
+    rows = []
+    for field, text in [('name', PROC['name']), ('desc', PROC['desc'])]:
+        for term in search_terms(text):
+            rows.append((field, term, IP, ID))
+    CONN.executemany('INSERT INTO terms VALUES (?,?,?,?)', rows)
+
+#################################################################################################
+# Fields that can be searched on as field:value, the column searched and how it is compared,
+# 'terms' fields match words of the name or description, the rest are indexed columns
+SEARCH_FIELDS = {'series':('series', 'text'), 'title':('title', 'text'), 'status':('status', 'text'),
+                 'type':('type', 'text'), 'transferred':('transferred', 'text'), 'tablo':('ip', 'text'),
+                 'id':('id', 'text'), 'season':('season_num', 'number'), 'episode':('episode_num', 'number'),
+                 'airdate':('airdate', 'date'), 'name':('name', 'terms'), 'desc':('desc', 'terms'),
+                 'description':('desc', 'terms')}
+
+#################################################################################################
+# Function to check if a search is a field query (series:Nova season:>=3) rather than a regex
+def search_is_query(SEARCH):
+    for token in string.split(SEARCH):
+        field = string.lower(string.splitfields(token, ':', 1)[0])
+        if string.find(token, ':') > 0 and SEARCH_FIELDS.has_key(field):
+            return 1
+    return 0
+
+#################################################################################################
+# Function to answer a query from the indexes, returns {(IP, ID): 1} for each match.
+# Words on their own must all start a word of the name, field:value narrows on a field,
+# numbers and dates can be compared (season:>=3, airdate:<2014-06-01) and dates given as a
+# range (airdate:2014-01-01..2014-12-31), values with spaces are quoted (series:"Whose Line").
+def db_search(DATABASE_FILE, QUERY):
+    selects = []
+    params = []
+    def terms(FIELD, VALUE):
+        for term in re.findall('[a-z0-9]+', string.lower(VALUE)):
+            selects.append('SELECT ip, id FROM terms WHERE field = ? AND term >= ? AND term < ?')
+            params.extend([FIELD, term, term+'{'])
+    for token in shlex.split(QUERY):
+        tmp = string.splitfields(token, ':', 1)
+        if len(tmp) == 1 or not SEARCH_FIELDS.has_key(string.lower(tmp[0])):
+            terms('name', token)
+            continue
+        column, kind = SEARCH_FIELDS[string.lower(tmp[0])]
+        value = tmp[1]
+        if kind == 'terms':
+            terms(column, value)
+            continue
+        op = '='
+        for prefix in ['>=', '<=', '>', '<', '=']:
+            if value[:len(prefix)] == prefix:
+                op, value = prefix, value[len(prefix):]
+                break
+        if kind == 'date' and string.find(value, '..') != -1:
+            low, high = string.splitfields(value, '..', 1)
+            selects.append('SELECT ip, id FROM recordings WHERE airdate >= ? AND airdate < ?')
+            params.extend([low, high+'~'])
+        elif kind == 'number':
+            selects.append('SELECT ip, id FROM recordings WHERE '+column+' '+op+' ?')
+            params.append(int(value))
+        elif kind == 'date' and op == '=':
+            selects.append('SELECT ip, id FROM recordings WHERE airdate >= ? AND airdate < ?')
+            params.extend([value, value+'~'])
+        elif kind == 'date':
+            selects.append('SELECT ip, id FROM recordings WHERE airdate '+op+' ?')
+            params.append(value)
+        elif op == '=':
+            selects.append('SELECT ip, id FROM recordings WHERE '+column+' = ? COLLATE NOCASE')
+            params.append(value)
+        else:
+            selects.append('SELECT ip, id FROM recordings WHERE '+column+' '+op+' ?')
+            params.append(value)
+    if selects == []:
+        selects.append('SELECT ip, id FROM recordings')
+    DB_LOCK.acquire()
     try:
-        tmp = open(DATABASE_FILE).readlines()
-        DB = eval(tmp[0])
+        rows = db_open(DATABASE_FILE).execute(string.join(selects, ' INTERSECT '), params).fetchall()
+    finally:
+        DB_LOCK.release()
+    results = {}
+    for IP, ID in rows:
+        results[(IP, ID)] = 1
+    return results
+
+#################################################################################################
+# Function to find the recordings a search matches, a field query goes to db_search, anything
+# else is matched against the name as a regex or a plain substring, returns [(IP, ID), ..]
+def search_match(DATABASE_FILE, TABLOS, DB, SEARCH, TV, MOVIES):
+    matches = []
+    query = search_is_query(SEARCH)
+    if query:
+        found = db_search(DATABASE_FILE, SEARCH)
+    else:
+        SEARCH_proc = re.compile(SEARCH, re.IGNORECASE)
+    for IP in TABLOS:
+        if query:
+            # only what the index found, and is still in DB, is looked at
+            keys = [ID for (ip, ID) in found.keys() if ip == IP and DB[IP].has_key(ID)]
+        else:
+            keys = DB[IP].keys()
+        keys.sort()
+        for ID in keys:
+            PROC = DB[IP][ID]
+            if query:
+                match_search = 1
+            else:
+                match_search = 0
+                if SEARCH_proc.match(PROC['name']) or SEARCH_proc.match(PROC['clean']):
+                    match_search = 1
+                if string.find(string.lower(PROC['name']), string.lower(SEARCH)) != -1:
+                    match_search = 1
+                if string.find(string.lower(PROC['clean']), string.lower(SEARCH)) != -1:
+                    match_search = 1
+            if PROC['type'] == 'movie' and not MOVIES:
+                match_search = 0
+            if PROC['type'] == 'tv' and not TV:
+                match_search = 0
+            if match_search:
+                matches.append((IP, ID))
+    return matches
+
+#################################################################################################
+# Function to read a watchlist, one rule per line written like the command line: the search
+# followed by -output:dir, -tv, -movies, -handbrake or -nohandbrake for that rule alone, what
+# a rule leaves out comes from the command line.  Blank lines and lines starting with # are
+# skipped, earlier rules win when more than one matches a recording.
+def watch_load(FILENAME, DIRECTORY, TV, MOVIES, HANDBRAKE):
+    rules = []
+    for line in open(FILENAME).readlines():
+        line = string.strip(line)
+        if line == '' or line[0] == '#':
+            continue
+        rule = {'search':'', 'output':DIRECTORY, 'tv':TV, 'movies':MOVIES, 'handbrake':HANDBRAKE, 'line':line}
+        for item in shlex.split(line):
+            if item[0] != '-':
+                rule['search'] = string.strip(rule['search']+' '+item)
+                continue
+            tmp = string.splitfields(item[1:],':',1)
+            option = string.lower(tmp[0])
+            if option == 'output' and len(tmp) == 2:
+                rule['output'] = tmp[1]
+            elif option == 'tv':
+                rule['tv'] = 1
+                rule['movies'] = 0
+            elif option == 'movie' or option == 'movies':
+                rule['tv'] = 0
+                rule['movies'] = 1
+            elif option == 'handbrake':
+                rule['handbrake'] = 1
+            elif option == 'nohandbrake':
+                rule['handbrake'] = 0
+            else:
+                raise ValueError('unknown option '+item+' in watchlist rule: '+line)
+        if rule['output'] == '':
+            raise ValueError('no -output for watchlist rule: '+line)
+        rules.append(rule)
+    return rules
+
+#################################################################################################
+# Every finished output is kept in the catalog table under a key naming what was recorded
+# rather than where, so the same episode or movie on another tablo is known to be done before
+# any of it is downloaded.  The catalog keeps the size and md5 of the file that was written.
+# Function to build the catalog key of a recording: series, season and episode for TV (series,
+# the time it aired and the episode title if there is no episode number, as there is none for
+# news or sports), title and year for movies.
+def catalog_key(PROC):
+    def norm(VALUE):
+        return string.join(re.findall('[a-z0-9]+', string.lower(str(VALUE))), ' ')
+    if PROC['type'] == 'movie':
+        return 'movie|'+norm(PROC['title'])+'|'+norm(PROC['date'])
+    try:
+        season, episode = int(PROC['season']), int(PROC['episode'])
     except:
-        DB = {'complete':{}}
+        season, episode = 0, 0
+    if episode == 0:
+        return 'tv|'+norm(PROC['series'])+'|'+str(PROC['date'])+'|'+norm(PROC['title'])
+    return 'tv|'+norm(PROC['series'])+'|s'+str(season)+'e'+str(episode)
+
+#################################################################################################
+# Function to look a key up in the catalog, returns {'ip', 'id', 'name', 'path', 'size', 'md5'}
+# or None if nothing has been catalogued under it
+def catalog_find(DATABASE_FILE, KEY):
+    DB_LOCK.acquire()
+    try:
+        row = db_open(DATABASE_FILE).execute('SELECT ip, id, name, path, size, md5 FROM catalog WHERE key = ?', (KEY,)).fetchone()
+    finally:
+        DB_LOCK.release()
+    if row is None:
+        return None
+    return {'ip':row[0], 'id':row[1], 'name':row[2], 'path':row[3], 'size':row[4], 'md5':row[5]}
+
+#################################################################################################
+# Function to add the finished output PATH of a recording to the catalog
+def catalog_add(DATABASE_FILE, KEY, IP, ID, NAME, PATH):
+    start = time.time()
+    digest = hashlib.md5()
+    size = 0
+    f = open(PATH, 'rb')
+    while 1:
+        data = f.read(1048576)
+        if data == '':
+            break
+        digest.update(data)
+        size = size + len(data)
+    f.close()
+    metric_time('catalog_seconds', time.time()-start, {}, {'video':str(ID), 'bytes':size})
+    DB_LOCK.acquire()
+    try:
+        conn = db_open(DATABASE_FILE)
+        conn.execute('INSERT OR REPLACE INTO catalog (key, ip, id, name, path, size, md5, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (KEY, IP, ID, NAME, PATH, size, digest.hexdigest(), time.time()))
+        conn.commit()
+    finally:
+        DB_LOCK.release()
+
+#################################################################################################
+# Function to flag a recording as changed so the next db_save writes (or deletes) its row
+def db_mark(DB, IP, ID):
+    DB_LOCK.acquire()
+    if not DB.has_key('dirty'):
+        DB['dirty'] = {}
+    DB['dirty'][(IP, ID)] = 1
+    DB_LOCK.release()
+
+#################################################################################################
+# Load database from the hard drive if already created, lets not query over and over, a database
+# that cannot be opened (or an older one that cannot be imported) raises an error
+def db_load(DATABASE_FILE):
+    start = time.time()
+    DB = {'complete':{}, 'dirty':{}}
+    conn = db_open(DATABASE_FILE)
+    DB_LOCK.acquire()
+    try:
+        config = conn.execute('SELECT key, value FROM config').fetchall()
+        rows = conn.execute('SELECT ip, id, '+string.join(DB_FIELDS, ', ')+' FROM recordings').fetchall()
+    finally:
+        DB_LOCK.release()
+    for key, value in config:
+        if not DB.has_key('config'):
+            DB['config'] = {}
+        DB['config'][key] = ast.literal_eval(value)
+    columns = {}
+    for i in range(len(DB_FIELDS)):
+        columns[DB_FIELDS[i]] = i + 2
+    fields = []
+    for field in RECORDING_FIELDS:
+        fields.append((field, columns[{'transfered':'transferred', 'desc':'description'}.get(field, field)]))
+    for row in rows:
+        IP, ID = row[0], row[1]
+        if not DB.has_key(IP):
+            DB[IP] = {}
+        REC = Recording()
+        for field, column in fields:
+            REC[field] = row[column]
+        if REC['transfered'] == '0':
+            REC['transfered'] = 0
+        if REC['cache'] is not None:
+            REC['cache'] = dict([(str(key), str(value)) for key, value in json.loads(REC['cache']).items()])
+        DB[IP][ID] = REC
+    metric_time('db_load_seconds', time.time()-start, {}, {'rows':len(rows)})
     return DB
 
+#################################################################################################
+# Function to read the metadata of a recording back from the database, None if there is none
+def db_meta(DATABASE_FILE, IP, ID):
+    DB_LOCK.acquire()
+    try:
+        row = db_open(DATABASE_FILE).execute('SELECT meta FROM recordings WHERE ip = ? AND id = ?', (IP, ID)).fetchone()
+    finally:
+        DB_LOCK.release()
+    if row is None or row[0] is None:
+        return None
+    return db_unpack(row[0])
+
+#################################################################################################
+# Function to give how many seconds ago the least recently swept of TABLOS was listed in full
+# (see db_update), None if one of them never has been
+def db_age(TABLOS, DB):
+    if not DB.has_key('config') or not DB['config'].has_key('swept'):
+        return None
+    oldest = None
+    for IP in TABLOS:
+        if not DB['config']['swept'].has_key(IP):
+            return None
+        if oldest is None or DB['config']['swept'][IP] < oldest:
+            oldest = DB['config']['swept'][IP]
+    if oldest is None:
+        return None
+    return max(0, time.time() - oldest)
+
+#################################################################################################
+# Function to write LINES (strings ending in a newline) to stdout a block at a time rather than
+# a field at a time, a pipe closed by the reader just ends the output
+def write_lines(LINES, BLOCK=1000):
+    buffer = []
+    try:
+        for line in LINES:
+            buffer.append(line)
+            if len(buffer) >= BLOCK:
+                sys.stdout.write(string.join(buffer, ''))
+                buffer = []
+        sys.stdout.write(string.join(buffer, ''))
+        sys.stdout.flush()
+    except IOError:
+        ohwell = 1
+
 #################################################################################################
 # Simple print of shows
 def db_print(TABLOS, DB):
     fields = ['airdate', 'series', 'season', 'episode', 'desc', 'status', 'transfered']
     fields_size = [10,30,4,4,30,10,4]
-    for IP in TABLOS:
-        print 'TabloTV '+str(IP)
-        keys = DB[IP].keys()
-        keys.sort()
-        print string.ljust('ID', 8),
-        for i in range(len(fields)):
-            fs= fields_size[i]
-            print string.ljust(fields[i], fs),
-        print
-        for ID in keys:
-            #print string.ljust(str(IP),15),
-            print string.ljust(str(ID),8),
-            for i in range(len(fields)):
-                f = DB[IP][ID]['proc'][fields[i]]
-                fs= fields_size[i]
-                print string.ljust(str(f)[:fs], fs),
-            print
+    def lines():
+        for IP in TABLOS:
+            yield 'TabloTV '+str(IP)+'\n'
+            keys = DB[IP].keys()
+            keys.sort()
+            yield string.join([string.ljust('ID', 8)] + [string.ljust(fields[i], fields_size[i]) for i in range(len(fields))], ' ')+'\n'
+            for ID in keys:
+                REC = DB[IP][ID]
+                yield string.join([string.ljust(str(ID), 8)] + [string.ljust(str(REC[fields[i]])[:fields_size[i]], fields_size[i]) for i in range(len(fields))], ' ')+'\n'
+    write_lines(lines())
 
 #################################################################################################
 # Scriptable print of shows
 def db_print_script(TABLOS, DB,CSV):
     fields = ['airdate', 'series', 'season', 'episode', 'desc', 'status', 'transfered']
-    fields_size = [10,30,4,4,30,10,4]
-    for IP in TABLOS:
-        keys = DB[IP].keys()
-        keys.sort()
-        for ID in keys:
-            print CSV+str(IP),
-            print CSV+str(ID),
-            for i in range(len(fields)):
-                f = DB[IP][ID]['proc'][fields[i]]
-                fs= fields_size[i]
-                print CSV+string.strip(str(f)),
-            print
+    def lines():
+        for IP in TABLOS:
+            keys = DB[IP].keys()
+            keys.sort()
+            for ID in keys:
+                REC = DB[IP][ID]
+                yield string.join([CSV+str(IP), CSV+str(ID)] + [CSV+string.strip(str(REC[field])) for field in fields], ' ')+'\n'
+    write_lines(lines())
+
+#################################################################################################
+# JSON lines print of shows, one object per recording, with season and episode as numbers (null
+# when the tablo gave none) and transferred null until a video has been downloaded
+def db_print_json(TABLOS, DB):
+    fields = ['type', 'name', 'airdate', 'series', 'title', 'desc', 'status', 'clean', 'ends']
+    def number(VALUE):
+        try:
+            return int(VALUE)
+        except:
+            return None
+    def lines():
+        for IP in TABLOS:
+            keys = DB[IP].keys()
+            keys.sort()
+            for ID in keys:
+                REC = DB[IP][ID]
+                row = {'ip':IP, 'id':ID, 'season':number(REC['season']), 'episode':number(REC['episode']),
+                       'transferred':REC['transfered'] or None}
+                for field in fields:
+                    row[field] = REC[field]
+                yield json.dumps(row, sort_keys=True)+'\n'
+    write_lines(lines())
+
+#################################################################################################
+# Function to build a get_video PROGRESS callback that records how far a transfer has got,
+# the row is saved every 20 segments so a restart can report where it left off.  It is called
+# from the pipeline's threads, so nothing is recorded once db_update has removed the recording.
+def db_progress(DATABASE_FILE, DB, IP, ID):
+    def progress(DONE, TOTAL):
+        DB_LOCK.acquire()
+        try:
+            if not DB.has_key(IP) or not DB[IP].has_key(ID):
+                return
+            DB[IP][ID]['progress'] = str(DONE)+'/'+str(TOTAL)
+            if DONE % 20 == 0 or DONE == TOTAL:
+                db_mark(DB, IP, ID)
+                db_save(DATABASE_FILE, DB)
+        finally:
+            DB_LOCK.release()
+    return progress
 
 #################################################################################################
-# Save database to hard drive
+# Save database to hard drive, only the recordings marked as changed are rewritten
 def db_save(DATABASE_FILE, DB):
-    tmp = open(DATABASE_FILE, 'w')
-    tmp.write(str(DB)+'\n')
-    tmp.close()
+    start = time.time()
+    rows = 0
+    DB_LOCK.acquire()
+    try:
+        conn = db_open(DATABASE_FILE)
+        if DB.has_key('config'):
+            for key in DB['config'].keys():
+                conn.execute('INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)', (key, repr(DB['config'][key])))
+        if DB.has_key('dirty'):
+            for IP, ID in DB['dirty'].keys():
+                if DB.has_key(IP) and DB[IP].has_key(ID):
+                    REC = DB[IP][ID]
+                    changed = 0
+                    if REC.meta is None:
+                        changed = conn.execute('UPDATE recordings SET '+string.join([field+' = ?' for field in DB_FIELDS], ', ')+' WHERE ip = ? AND id = ?',
+                                               db_fields(REC)+(IP, ID)).rowcount
+                    if not changed:
+                        row = (IP, ID, db_pack(REC.meta)) + db_fields(REC)
+                        conn.execute('INSERT OR REPLACE INTO recordings (ip, id, meta, '+string.join(DB_FIELDS, ', ')+') VALUES ('+
+                                     string.join(['?']*len(row), ',')+')', row)
+                        db_index(conn, IP, ID, REC)
+                        REC.meta = None
+                else:
+                    conn.execute('DELETE FROM recordings WHERE ip = ? AND id = ?', (IP, ID))
+                    db_index(conn, IP, ID, None)
+                rows = rows + 1
+            DB['dirty'] = {}
+        conn.commit()
+    finally:
+        DB_LOCK.release()
+    metric_time('db_save_seconds', time.time()-start, {}, {'rows':rows})
     return DB
 
 #################################################################################################
@@ -324,8 +1976,34 @@ if __name__ == '__main__':
     MOVIES = 1
     TV = 1
     CSV = 0
+    JSON = 0
+    MAXAGE = 0
     ONLY = []
     COMPLETE = 0
+    WORKERS = 4
+    RETRIES = 3
+    INFLIGHT = 64
+    STREAM = 0
+    FOLLOW = 0
+    POLL = 60
+    METRICSFILE = ''
+    METRICSPORT = 0
+    POOLSIZE = POOL_SIZE
+    TIMEOUT = POOL_TIMEOUT
+    METAWORKERS = 8
+    DOWNLOADERS = 0
+    PERTABLO = 1
+    ORDER = 'watch'
+    REMUXERS = 1
+    TRANSCODERS = 1
+    DEPTH = 2
+    WATCH = ''
+    LISTPOLL = 60
+    TABLORATE = 0
+    MAXRATE = 0
+    RATESCHED = ''
+    DISKFREE = SPACE_MARGIN/1048576
+    FASTPOLL = 20
     
     #################################################################################################
     # Determine Command Line options
@@ -359,19 +2037,32 @@ if __name__ == '__main__':
         DEBUG = 1
     if CMDLINE_OPTIONS.has_key('testing'):
         TESTING = 1
+    if CMDLINE_OPTIONS.has_key('stream'):
+        STREAM = 1
+    if CMDLINE_OPTIONS.has_key('follow'):
+        FOLLOW = 1
     if CMDLINE_OPTIONS.has_key('csv'):
         try:
             CSV = CMDLINE_OPTIONS['csv'][0]
         except:
             CSV = '|'
         DEBUG = 0
-    if CMDLINE_OPTIONS.has_key('proc'):
-        ONLY = CMDLINE_OPTIONS['proc']
+    if CMDLINE_OPTIONS.has_key('json'):
+        JSON = 1
+        DEBUG = 0
+    if CMDLINE_OPTIONS.has_key('cached'):
+        MAXAGE = None
+    if CMDLINE_OPTIONS.has_key('proc') and CMDLINE_OPTIONS['proc'] != []:
+        ONLY = string.splitfields(CMDLINE_OPTIONS['proc'][0], ':')
     if CMDLINE_OPTIONS.has_key('c') or CMDLINE_OPTIONS.has_key('complete'):
         COMPLETE = 1
     if CMDLINE_OPTIONS.has_key('db'):
         DATABASE = CMDLINE_OPTIONS['db'][0]
-        DB = db_load(DATABASE)
+        try:
+            DB = db_load(DATABASE)
+        except:
+            print 'Could not open the database '+DATABASE+' ('+str(sys.exc_info()[1])+')'
+            sys.exit(1)
         if DB.has_key('config') and false:
             if DB['config'].has_key('CMDLINE_OPTIONS'):
                 CMDLINE_OPTIONS = DB['config']['CMDLINE_OPTIONS']
@@ -381,7 +2072,7 @@ if __name__ == '__main__':
                         tmp = string.splitfields(item[1:],':')
                         CMDLINE_OPTIONS[string.lower(tmp[0])] = tmp[1:]
     if CMDLINE_OPTIONS.has_key('tablo'):
-        TABLOS = CMDLINE_OPTIONS['tablo']
+        TABLOS = string.splitfields(CMDLINE_OPTIONS['tablo'][0], ':')
     if CMDLINE_OPTIONS.has_key('ffmpeg'):
         FFMPEG = CMDLINE_OPTIONS['ffmpeg'][0]
     if CMDLINE_OPTIONS.has_key('output'):
@@ -390,6 +2081,61 @@ if __name__ == '__main__':
         TEMPDIR = CMDLINE_OPTIONS['temp'][0]
     if CMDLINE_OPTIONS.has_key('sleep'):
         SLEEP = CMDLINE_OPTIONS['sleep'][0]
+    if CMDLINE_OPTIONS.has_key('watch'):
+        WATCH = CMDLINE_OPTIONS['watch'][0]
+    try:
+        if CMDLINE_OPTIONS.has_key('workers'):
+            WORKERS = max(1, int(CMDLINE_OPTIONS['workers'][0]))
+        if CMDLINE_OPTIONS.has_key('retries'):
+            RETRIES = max(0, int(CMDLINE_OPTIONS['retries'][0]))
+        if CMDLINE_OPTIONS.has_key('inflight'):
+            INFLIGHT = max(1, int(CMDLINE_OPTIONS['inflight'][0]))
+        if CMDLINE_OPTIONS.has_key('pool'):
+            POOLSIZE = max(1, int(CMDLINE_OPTIONS['pool'][0]))
+        if CMDLINE_OPTIONS.has_key('timeout'):
+            TIMEOUT = float(CMDLINE_OPTIONS['timeout'][0])
+        if CMDLINE_OPTIONS.has_key('metaworkers'):
+            METAWORKERS = max(1, int(CMDLINE_OPTIONS['metaworkers'][0]))
+        if CMDLINE_OPTIONS.has_key('downloaders'):
+            DOWNLOADERS = max(1, int(CMDLINE_OPTIONS['downloaders'][0]))
+        if CMDLINE_OPTIONS.has_key('pertablo'):
+            PERTABLO = max(1, int(CMDLINE_OPTIONS['pertablo'][0]))
+        if CMDLINE_OPTIONS.has_key('order'):
+            ORDER = string.lower(CMDLINE_OPTIONS['order'][0])
+            if ORDER not in ['watch', 'newest', 'shortest']:
+                FAIL = 1
+        if CMDLINE_OPTIONS.has_key('remuxers'):
+            REMUXERS = max(1, int(CMDLINE_OPTIONS['remuxers'][0]))
+        if CMDLINE_OPTIONS.has_key('transcoders'):
+            if CMDLINE_OPTIONS['transcoders'][0] == 'auto':
+                TRANSCODERS = multiprocessing.cpu_count()
+            else:
+                TRANSCODERS = max(1, int(CMDLINE_OPTIONS['transcoders'][0]))
+        if CMDLINE_OPTIONS.has_key('depth'):
+            DEPTH = max(1, int(CMDLINE_OPTIONS['depth'][0]))
+        if CMDLINE_OPTIONS.has_key('follow') and CMDLINE_OPTIONS['follow'] != []:
+            POLL = max(1, int(CMDLINE_OPTIONS['follow'][0]))
+        if CMDLINE_OPTIONS.has_key('metrics'):
+            METRICSFILE = CMDLINE_OPTIONS['metrics'][0]
+        if CMDLINE_OPTIONS.has_key('metricsport'):
+            METRICSPORT = int(CMDLINE_OPTIONS['metricsport'][0])
+        if CMDLINE_OPTIONS.has_key('listpoll'):
+            LISTPOLL = max(1, int(CMDLINE_OPTIONS['listpoll'][0]))
+        if CMDLINE_OPTIONS.has_key('fastpoll'):
+            FASTPOLL = max(1, int(CMDLINE_OPTIONS['fastpoll'][0]))
+        if CMDLINE_OPTIONS.has_key('tablorate'):
+            TABLORATE = max(0, float(CMDLINE_OPTIONS['tablorate'][0]))
+        if CMDLINE_OPTIONS.has_key('maxrate'):
+            MAXRATE = max(0, float(CMDLINE_OPTIONS['maxrate'][0]))
+        if CMDLINE_OPTIONS.has_key('diskfree'):
+            DISKFREE = max(0, int(CMDLINE_OPTIONS['diskfree'][0]))
+        if CMDLINE_OPTIONS.has_key('maxage') and MAXAGE is not None:
+            MAXAGE = max(0, float(CMDLINE_OPTIONS['maxage'][0]))
+        if CMDLINE_OPTIONS.has_key('ratesched'):
+            RATESCHED = CMDLINE_OPTIONS['ratesched'][0]
+        rate_config(TABLORATE, MAXRATE, RATESCHED)
+    except:
+        FAIL = 1
 
         if DEBUG: print 'DB:'+DATABASE
         if DEBUG: print TABLOS
@@ -397,18 +2143,25 @@ if __name__ == '__main__':
         if DEBUG: print 'DIR:'+DIRECTORY
         if DEBUG: print 'TEMP:'+TEMPDIR
     
-    if FAIL or DATABASE == '' or TABLOS == [] or FFMPEG == '' or DIRECTORY == '' or TEMPDIR == '':
+    if FAIL or DATABASE == '' or TABLOS == [] or FFMPEG == '' or (DIRECTORY == '' and WATCH == '') or TEMPDIR == '':
         print 'Tablo Extractor (Version '+str(VERSION)+')'
         print ' Usage: '+sys.argv[0]+' <options> "search regex"'
         print ' Options:    -tablo:IP_ADDR        tablo ip address (multiple tablos seperated by a colon)'
         print '             -ffmpeg:PATH          path to ffmpeg (ex /bin/ffmpeg)'
         print '             -db:file              Tablo Extractor Database File'
         print '             -output:dir           Save final files here'
+        print '             -watch:file           Process every search in file in one pass, one rule per line,'
+        print '                                   each may add -output:dir -tv -movies -handbrake -nohandbrake'
         print '             -temp:dir             Temporary working directory for received files'
-        print '             -a                    Reprocess ever 30 minutes, do not exit'
+        print '             -a                    Keep running, checking the Tablo(s) as often as needed, do not exit,'
+        print '                                   matches found while videos are transferring join those already queued'
         print '             -list                 List videos on Tablo(s)'
         print '             -csv                  List videos on Tablo(s) in a script readable format'
         print '                                   note: this sets debug/printing to off.'
+        print '             -json                 List videos on Tablo(s) as JSON lines (also sets debug off)'
+        print '             -maxage:S             With -list/-csv/-json, only check the Tablo(s) when the database'
+        print '                                   was last brought up to date over S seconds ago (default 0)'
+        print '             -cached               With -list/-csv/-json, answer from the database without checking'
         print '             -handbrake            Post process with handbrake (and delete .mp4 file)'
         print '             -tv                   Process only TV shows'
         print '             -movies               Process only Movies'
@@ -416,24 +2169,134 @@ if __name__ == '__main__':
         print '             -c                    Mark matched videos as complete/transfered'
         print '             -debug                Display all msgs'
         print '             -testing              Only processes 1 segmant from Tablo - to test directories, etc - Faster'
-        print '             -sleep                Number of seconds to sleep, used with -a'
+        print '             -sleep                Longest wait between listing checks with -a (default 1800)'
+        print '             -listpoll:S           With -a, check the listings every S seconds while they change,'
+        print '                                   waiting twice as long each time nothing did, up to -sleep (default 60)'
+        print '             -fastpoll:S           With -a, check a recording every S seconds around its expected end (default 20)'
+        print '             -workers:N            Download N segments at once from each Tablo (default 4)'
+        print '             -retries:N            Retry a failed segment N times before giving up (default 3)'
+        print '             -inflight:MB          Stop fetching ahead once MB of segments are waiting (default 64)'
+        print '             -stream               Pipe segments straight into ffmpeg, nothing is staged in temp'
+        print '             -pool:N               Keep up to N connections open to each Tablo (default 8)'
+        print '             -timeout:S            Give up on a Tablo request after S seconds (default 30)'
+        print '             -metaworkers:N        Fetch N metadata files at once from each Tablo (default 8)'
+        print '             -downloaders:N        Download N videos at once (default -pertablo for each Tablo)'
+        print '             -pertablo:N           Download at most N videos at once from each Tablo (default 1)'
+        print '             -order:O              Download "watch" (in watchlist order, the default), "newest" or'
+        print '                                   "shortest" videos first, the queue is shared by all Tablos'
+        print '             -remuxers:N           Run N ffmpeg remuxes at once (default 1)'
+        print '             -transcoders:N        Run N HandBrake encodes at once, "auto" for one per core (default 1)'
+        print '             -depth:N              Let up to N videos wait between stages (default 2)'
+        print '             -follow:S             Download matching recordings while they are still recording,'
+        print '                                   with -a the Tablo is checked every S seconds (default 60)'
+        print '             -tablorate:MB         Download at most MB megabytes a second from each Tablo (default no cap)'
+        print '             -maxrate:MB           Download at most MB megabytes a second from all Tablos together'
+        print '             -ratesched:HHMM-HHMM=T/A,..  Between those times cap each Tablo at T and all at A MB/s'
+        print '                                   instead, e.g. -ratesched:1800-2300=1/2,0100-0700=0/0 (0 is no cap)'
+        print '             -diskfree:MB          Leave MB free on the temp and output disks, videos that do not fit'
+        print '                                   are put off until there is room (default 1024)'
+        print '             -metrics:file         Append a JSON line with the timing of every stage to file'
+        print '             -metricsport:N        With -a, serve counters and timers on http://localhost:N/metrics'
         print ' Note: Search Terms are optional and should be in a quote if more than one word.'
+        print '       A search with field:value terms is answered from the database indexes, e.g.'
+        print '       "series:Nova season:>=3 status:finished" or "desc:volcano airdate:2014-01-01..2014-06-30"'
+        print '       Fields: series title season episode airdate status type transferred tablo id name desc'
         sys.exit()
+    pool_config(POOLSIZE, TIMEOUT)
+    SPACE_MARGIN = DISKFREE*1048576
+    if METRICSFILE != '':
+        metrics_open(METRICSFILE)
+    if METRICSPORT and LOOP == 1:
+        metrics_serve(METRICSPORT)
+    RULES = [{'search':SEARCH, 'output':DIRECTORY, 'tv':TV, 'movies':MOVIES, 'handbrake':HANDBRAKE, 'line':SEARCH}]
     try:
-        SEARCH_proc = re.compile(SEARCH, re.IGNORECASE)
+        if WATCH != '':
+            RULES = watch_load(WATCH, DIRECTORY, TV, MOVIES, HANDBRAKE)
     except:
-        print 'Invalid search specification'
+        print 'Invalid watchlist '+WATCH+' ('+str(sys.exc_info()[1])+')'
         sys.exit()
+    for RULE in RULES:
+        try:
+            if search_is_query(RULE['search']):
+                db_search(DATABASE, RULE['search'])
+            else:
+                re.compile(RULE['search'], re.IGNORECASE)
+        except:
+            print 'Invalid search specification: '+RULE['line']
+            sys.exit()
         
     #################################################################################################
     # Loop through tablos searching for videos
 
+    # With -a the listings are swept every LISTPOLL seconds, backing off to SLEEP while nothing
+    # changes, recordings in progress are checked on their own (see poll_due) and the pipeline
+    # runs in the background so the Tablos are still watched while it works, each pass adding
+    # its new matches to PENDING.
+    FOLLOWING = {}              # (IP, ID): thread following a recording in progress
+    WAKE = threading.Event()    # set when a followed recording finishes or the pipeline stops
+    CHECKED = {}                # (IP, ID): when the metadata of a recording in progress was checked
+    TRANSFER = None             # thread running the pipeline with -a
+    PENDING = job_queue([], lambda JOBS: order_sort(JOBS, ORDER, TABLOS), LOOP == 1)
+    NEXTLIST = 0
+    LISTWAIT = LISTPOLL
+    DB = db_load(DATABASE)
+    try:
+        space_clean(TEMPDIR, DEBUG, DB)
+    except:
+        print ' - Could not clean up '+TEMPDIR+' ('+str(sys.exc_info()[1])+')'
+
+    # -list, -csv and -json answer from the database when it is recent enough (-maxage) or
+    # whatever its age (-cached), otherwise only once the tablos have been checked
+    def listing(DB):
+        for IP in TABLOS:
+            if not DB.has_key(IP):
+                DB[IP] = {}
+        if JSON:
+            db_print_json(TABLOS, DB)
+        elif CSV != 0:
+            db_print_script(TABLOS, DB, CSV)
+        else:
+            if DEBUG: print ' - Listing videos found on Tablo(s)'
+            db_print(TABLOS, DB)
+        sys.exit()
+    if LIST or CSV != 0 or JSON:
+        AGE = db_age(TABLOS, DB)
+        if MAXAGE is None or (AGE is not None and AGE < MAXAGE):
+            if DEBUG and AGE is not None: print ' - Using the database, last checked '+str(int(AGE))+' second(s) ago'
+            listing(DB)
+
     while LOOP != 2:
         if LOOP == 0:
             LOOP = 2
-        if DEBUG: print ' - Downloading data from TabloTVs'
-        DB = db_load(DATABASE)
-        DB, found_count, add_count, del_count, proc_count = db_update(TABLOS, DB)
+        now = time.time()
+        try:
+            if now >= NEXTLIST:
+                if DEBUG: print ' - Downloading data from TabloTVs'
+                DB, found_count, add_count, del_count, proc_count = db_update(TABLOS, DB, METAWORKERS)
+                for IP in TABLOS:
+                    for ID in DB[IP].keys():
+                        if DB[IP][ID]['status'] != 'finished':
+                            CHECKED[(IP, ID)] = now
+                if add_count or del_count or proc_count:
+                    LISTWAIT = LISTPOLL
+                else:
+                    LISTWAIT = min(LISTWAIT*2, max(LISTPOLL, float(SLEEP)))
+                NEXTLIST = now + LISTWAIT
+            else:
+                DUE, wait = poll_due(TABLOS, DB, CHECKED, now, FASTPOLL, LISTPOLL*5)
+                found_count, add_count, del_count, proc_count = 0, 0, 0, 0
+                if DUE != {}:
+                    if DEBUG: print ' - Checking '+str(len(DUE))+' recording(s) in progress'
+                    DB, found_count, add_count, del_count, proc_count = db_update(TABLOS, DB, METAWORKERS, DUE)
+                for KEY in DUE.keys():
+                    CHECKED[KEY] = now
+        except:
+            # a pass that fails (e.g. the network is down) is tried again later, not fatal with -a
+            if LOOP != 1:
+                raise
+            print ' - Could not check the Tablo(s) ('+str(sys.exc_info()[1])+')'
+            found_count, add_count, del_count, proc_count = 0, 0, 0, 0
+            NEXTLIST = now + LISTPOLL
         if not DB.has_key('config'):
             DB['config'] = {}
         DB['config']['CMDLINE_OPTIONS'] = CMDLINE_OPTIONS
@@ -443,83 +2306,198 @@ if __name__ == '__main__':
         if DEBUG: print ' - Updated metadata for '+str(proc_count)+' video(s)'
         if DEBUG: print ' - Removed metadata for '+str(del_count)+' deleted video(s)'
 
-        if CSV != 0:
-            db_print_script(TABLOS, DB, CSV)
-            sys.exit()
-
-        if LIST:
-            if DEBUG: print ' - Listing videos found on Tablo(s)'
-            db_print(TABLOS, DB)
-            sys.exit()
+        if LIST or CSV != 0 or JSON:
+            listing(DB)
             
     
         QUEUE = []
+        FOLLOWQ = []
         count_found = 0
         count_finished = 0
         count_unprocessed = 0
         count_recording = 0
         count_transfered = 0
-        for IP in TABLOS:
-            keys = DB[IP].keys()
-            keys.sort()
-            for ID in keys:
-                PROC = DB[IP][ID]['proc']
-                match_status = SEARCH_proc.match(PROC['name'])
-                match_status_orig = SEARCH_proc.match(PROC['clean'])
-                match_search = 0
-                if string.find(string.lower(PROC['name']), string.lower(SEARCH)) != -1:
-                    match_search = 1
-                if string.find(string.lower(PROC['clean']), string.lower(SEARCH)) != -1:
-                    match_search = 1
-                if match_status or match_status_orig:
-                    match_search = 1
-                if PROC['type'] == 'movie' and not MOVIES:
-                    match_search = 0
-                if PROC['type'] == 'tv' and not TV:
-                    match_search = 0
-                if ONLY != []:
-                    match_search = 0
-                    if IP == ONLY[0] and ID == ONLY[1]:
-                        match_search = 1
-                        QUEUE.append([IP,ID,PROC['clean'],PROC['status'],PROC['transfered'], PROC])
-                        print ' - Only processing requested video'
-                elif match_search:
-                    count_found = count_found + 1
-                    if PROC['status'] != 'finished':
-                        count_recording = count_recording + 1
-                    elif PROC['transfered'] != 'complete':
-                        count_unprocessed = count_unprocessed + 1
-                        QUEUE.append([IP,ID,PROC['clean'],PROC['status'],PROC['transfered'], PROC])
-                    else:
-                        count_transfered = count_transfered + 1
+        if WATCH != '':
+            try:
+                RULES = watch_load(WATCH, DIRECTORY, TV, MOVIES, HANDBRAKE)
+            except:
+                print ' - Keeping the previous watchlist, '+WATCH+' could not be read ('+str(sys.exc_info()[1])+')'
+        QUEUED = {}
+        for RULE in RULES:
+            if ONLY != []:
+                if DB.has_key(ONLY[0]) and DB[ONLY[0]].has_key(ONLY[1]):
+                    PROC = DB[ONLY[0]][ONLY[1]]
+                    QUEUE.append([ONLY[0],ONLY[1],PROC['clean'],PROC['status'],PROC['transfered'], PROC, RULE])
+                    print ' - Only processing requested video'
+                break
+            try:
+                MATCHES = search_match(DATABASE, TABLOS, DB, RULE['search'], RULE['tv'], RULE['movies'])
+            except:
+                print ' - Skipping watchlist rule: '+RULE['line']+' ('+str(sys.exc_info()[1])+')'
+                continue
+            for IP, ID in MATCHES:
+                # one sweep serves every rule, a recording goes to the first rule that matches it,
+                # and one already waiting or in the pipeline is left there
+                if QUEUED.has_key((IP, ID)) or job_queued(PENDING, [(IP, ID)]):
+                    continue
+                QUEUED[(IP, ID)] = RULE
+                PROC = DB[IP][ID]
+                count_found = count_found + 1
+                if PROC['status'] != 'finished':
+                    count_recording = count_recording + 1
+                    if FOLLOW and PROC['transfered'] != 'complete':
+                        FOLLOWQ.append([IP,ID,PROC['clean']])
+                elif PROC['transfered'] != 'complete':
+                    count_unprocessed = count_unprocessed + 1
+                    QUEUE.append([IP,ID,PROC['clean'],PROC['status'],PROC['transfered'], PROC, RULE])
+                else:
+                    count_transfered = count_transfered + 1
     
         if DEBUG: print ' - Search found '+str(count_found)+' match(es), '+str(count_recording)+' still recording, '+str(count_transfered)+' already done, '+str(count_unprocessed)+' to be downloaded.'
-        if 1:
-            for item in QUEUE:
-                print '   - Match: '+item[2]
-                if DEBUG: print ' DIR: '+DIRECTORY
-                NDIR = DIRECTORY
-                if CREATE_DIR and not COMPLETE:
-                    if item[5]['type'] == 'tv':
-                        SERIES = item[5]['series']
-                        NDIR = DIRECTORY+'/'+clean(SERIES)
-                        try:   
-                            os.mkdir(NDIR)
-                        except:
-                            already_exists = 1
-                if HANDBRAKE and not COMPLETE:
-                    get_video(item[0], item[1], NDIR, TEMPDIR, FFMPEG, item[2], DEBUG, TESTING)    
-                    cmd = 'HandBrakeCLI -i "'+NDIR+'/'+item[2]+'.mp4" -f -a 1 -E copy -f mkv -O -e x264 -q 22.0 --loose-anamorphic --modulus 2 -m --x264-preset medium --h264-profile high --h264-level 4.1 --decomb --denoise=weak -v -o "'+NDIR+'/'+item[2]+'.mkv"'
-                    os.system(cmd)
-                    try:
-                        os.remove(NDIR+'/'+item[2]+'.mp4')
+        JOBS = []
+        CATALOGUED = {}
+        for item in QUEUE:
+            # the same show on another tablo (or queued twice this pass) is only downloaded once
+            KEY = catalog_key(item[5])
+            if ONLY == [] and not COMPLETE:
+                if job_queued(PENDING, [('catalog', KEY)]):
+                    if DEBUG: print '   - Already queued: '+item[2]
+                    continue
+                DUPLICATE = catalog_find(DATABASE, KEY)
+                if DUPLICATE is not None and (DUPLICATE['ip'], DUPLICATE['id']) != (item[0], item[1]):
+                    print '   - Already have: '+item[2]+' ('+DUPLICATE['path']+' from '+DUPLICATE['ip']+')'
+                    DB[item[0]][item[1]]['transfered'] = 'complete'
+                    db_mark(DB, item[0], item[1])
+                    DB = db_save(DATABASE, DB)
+                    continue
+                if CATALOGUED.has_key(KEY):
+                    if DEBUG: print '   - Already queued: '+item[2]+' (from '+CATALOGUED[KEY]+')'
+                    continue
+            CATALOGUED[KEY] = item[0]
+            print '   - Match: '+item[2]
+            if DEBUG: print ' DIR: '+item[6]['output']
+            NDIR = item[6]['output']
+            if CREATE_DIR and not COMPLETE:
+                if item[5]['type'] == 'tv':
+                    SERIES = item[5]['series']
+                    NDIR = item[6]['output']+'/'+clean(SERIES)
+                    try:   
+                        os.mkdir(NDIR)
                     except:
-                        ohwell = 1
-                elif not COMPLETE:                    
-                    get_video(item[0], item[1], NDIR, TEMPDIR, FFMPEG, item[2], DEBUG, TESTING)
-                DB[item[0]][item[1]]['proc']['transfered'] = 'complete'
+                        already_exists = 1
+            if COMPLETE:
+                DB[item[0]][item[1]]['transfered'] = 'complete'
+                db_mark(DB, item[0], item[1])
                 DB = db_save(DATABASE, DB)
+            else:
+                JOBS.append({'item':item, 'dir':NDIR, 'segments':None, 'skip':0, 'handbrake':item[6]['handbrake'], 'space':None,
+                             'rank':RULES.index(item[6]), 'segs':None, 'keys':[(item[0], item[1]), ('catalog', KEY)]})
+
+        #################################################################################################
+        # Download, remux and transcode stages, each with its own workers (see pipeline)
+        def download(JOB):
+            item = JOB['item']
+            if JOB['handbrake'] and item[4] == 'downloaded' and os.path.exists(JOB['dir']+'/'+item[2]+'.mp4'):
+                JOB['skip'] = 1
+                JOB['space'] = space_reserve([(JOB['dir'], os.path.getsize(JOB['dir']+'/'+item[2]+'.mp4'), 'mkv')])
+            else:
+                SEGS = JOB['segs']
+                if SEGS is None:
+                    SEGS = get_segs(item[0], item[1])
+                JOB['space'] = space_reserve(space_needed(SEGS, item[1], TEMPDIR, JOB['dir'], STREAM, JOB['handbrake']))
+            if JOB['space'] is None:
+                raise IOError('not enough disk space, deferred')
+            if JOB['skip']:
+                return
+            PROGRESS = db_progress(DATABASE, DB, item[0], item[1])
+            JOB['segments'] = fetch_video(item[0], item[1], JOB['dir'], TEMPDIR, FFMPEG, item[2], DEBUG, TESTING, WORKERS, RETRIES, INFLIGHT*1024*1024, 0, STREAM, PROGRESS, SEGS)
+        def remux(JOB):
+            item = JOB['item']
+            if not JOB['skip']:
+                remux_video(item[1], JOB['segments'], JOB['dir'], TEMPDIR, FFMPEG, item[2], DEBUG)
+            space_release(JOB['space'], 'temp')
+        def transcode(JOB):
+            item = JOB['item']
+            output = JOB['dir']+'/'+item[2]+'.mp4'
+            if JOB['handbrake']:
+                transcode_video(JOB['dir'], item[2], DEBUG)
+                output = JOB['dir']+'/'+item[2]+'.mkv'
+            try:
+                catalog_add(DATABASE, catalog_key(item[5]), item[0], item[1], item[2], output)
+            except:
+                print '   - Not catalogued: '+output+' ('+str(sys.exc_info()[1])+')'
+        def transfered(STAGE, JOB, ERROR):
+            item = JOB['item']
+            if ERROR is not None or STAGE == 2:
+                space_release(JOB['space'])
+            if ERROR is not None:
+                print '   - Failed: '+item[2]+' ('+str(ERROR[1])+')'
+                return
+            # with -a the main thread may be changing DB (see db_update) while this runs
+            DB_LOCK.acquire()
+            try:
+                if not DB.has_key(item[0]) or not DB[item[0]].has_key(item[1]):
+                    return
+                if STAGE == 1 and JOB['handbrake']:
+                    DB[item[0]][item[1]]['transfered'] = 'downloaded'
+                elif STAGE == 2:
+                    DB[item[0]][item[1]]['transfered'] = 'complete'
+                    if DEBUG: print '   - Done: '+item[2]
+                else:
+                    return
+                db_mark(DB, item[0], item[1])
+                db_save(DATABASE, DB)
+            finally:
+                DB_LOCK.release()
+
+        #################################################################################################
+        # Recordings still in progress, with -a each is followed by its own thread which wakes the
+        # main loop up as soon as the recording finishes, otherwise one pass is made over each
+        def follow(IP, ID, NAME, POLL):
+            try:
+                follow_video(IP, ID, TEMPDIR, DEBUG, TESTING, WORKERS, RETRIES, INFLIGHT*1024*1024, POLL)
+            except:
+                print '   - Failed following: '+NAME+' ('+str(sys.exc_info()[1])+')'
+            if POLL:
+                CHECKED[(IP, ID)] = 0
+                WAKE.set()
+        for item in FOLLOWQ:
+            if LOOP == 1:
+                if not FOLLOWING.has_key((item[0], item[1])) or not FOLLOWING[(item[0], item[1])].isAlive():
+                    print '   - Following: '+item[2]
+                    t = threading.Thread(target=follow, args=(item[0], item[1], item[2], POLL))
+                    t.setDaemon(1)
+                    t.start()
+                    FOLLOWING[(item[0], item[1])] = t
+        #################################################################################################
+        # One queue for all tablos, in ORDER, each downloader takes the first video whose tablo is
+        # not already sending PERTABLO others.  With -a the pipeline keeps running and each pass
+        # adds its new jobs to the queue (PENDING) it is working through.
+        for JOB in order_jobs(JOBS, ORDER, TABLOS, METAWORKERS):
+            job_add(PENDING, JOB['keys'], JOB)
+        LIMIT = (lambda JOB: JOB['item'][0], PERTABLO)
+        STAGES = [(download, DOWNLOADERS or len(TABLOS)*PERTABLO), (remux, REMUXERS), (transcode, TRANSCODERS)]
+        if LOOP == 1 and (TRANSFER is None or not TRANSFER.isAlive()):
+            def transfer(STAGES):
+                try:
+                    pipeline(PENDING, STAGES, DEPTH, transfered, LIMIT)
+                finally:
+                    WAKE.set()
+            TRANSFER = threading.Thread(target=transfer, args=(STAGES,))
+            TRANSFER.setDaemon(1)
+            TRANSFER.start()
+        elif LOOP != 1:
+            job_close(PENDING)
+            pipeline(PENDING, STAGES, DEPTH, transfered, LIMIT)
+            for item in FOLLOWQ:
+                print '   - Following: '+item[2]
+                follow(item[0], item[1], item[2], 0)
 
         if LOOP == 1:
-            if DEBUG: print ' - Sleeping.'
-            time.sleep(float(SLEEP))
+            DUE, wait = poll_due(TABLOS, DB, CHECKED, time.time(), FASTPOLL, LISTPOLL*5)
+            if wait is None:
+                wait = NEXTLIST - time.time()
+            wait = max(1, min(wait, NEXTLIST - time.time()))
+            if DEBUG: print ' - Sleeping '+str(int(wait))+' seconds.'
+            WAKE.wait(wait)
+            WAKE.clear()
@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+
+# Tests for TabloToGo.v1.py, run with: python -m unittest discover tests
+# Nothing here talks to a Tablo, the network side is replaced where a test needs it.
+
+import os,sys,imp,shutil,tempfile,unittest
+
+sys.dont_write_bytecode = True
+TTG = imp.load_source('tablotogo', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TabloToGo.v1.py'))
+
+#################################################################################################
+# Function to write a stand-in ffmpeg to DIRECTORY that copies stdin to its output file (the last
+# argument) and exits with STATUS
+def fake_ffmpeg(DIRECTORY, STATUS):
+    path = DIRECTORY+'/ffmpeg'
+    script = open(path, 'w')
+    script.write('#!'+sys.executable+'\n')
+    script.write('import sys\n')
+    script.write('open(sys.argv[-1], "wb").write(sys.stdin.read())\n')
+    script.write('sys.exit('+str(STATUS)+')\n')
+    script.close()
+    os.chmod(path, 0755)
+    return path
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = TTG.get_segments
+    def tearDown(self):
+        TTG.get_segments = self.saved
+        shutil.rmtree(self.dir)
+    def segments(self, FAIL_AT=None):
+        def get_segments(IPADDR, VIDEOID, SEGMENTS, WRITER, WORKERS, RETRIES, INFLIGHT, DEBUG):
+            for SEGMENT in SEGMENTS:
+                if SEGMENT == FAIL_AT:
+                    raise IOError('segment '+str(SEGMENT)+' failed')
+                WRITER(SEGMENT, '\x47'+'\x00'*187)
+        TTG.get_segments = get_segments
+    def fetch(self, FFMPEG):
+        return TTG.fetch_video('127.0.0.1', 100, self.dir, self.dir, FFMPEG, 'Show', 0, 0, STREAM=1, SEGS=[(1, 188), (2, 188), (3, 188)])
+
+    def test_ffmpeg_failure_removes_output(self):
+        self.segments()
+        self.assertRaises(IOError, self.fetch, fake_ffmpeg(self.dir, 1))
+        self.assertFalse(os.path.exists(self.dir+'/Show.mp4'))
+
+    def test_segment_failure_removes_output(self):
+        self.segments(FAIL_AT=2)
+        self.assertRaises(IOError, self.fetch, fake_ffmpeg(self.dir, 0))
+        self.assertFalse(os.path.exists(self.dir+'/Show.mp4'))
+
+    def test_success_keeps_output(self):
+        self.segments()
+        self.assertEqual(self.fetch(fake_ffmpeg(self.dir, 0)), None)
+        self.assertEqual(os.path.getsize(self.dir+'/Show.mp4'), 3*188)
+
+    def test_failed_stream_is_not_completed(self):
+        self.segments()
+        ffmpeg = fake_ffmpeg(self.dir, 1)
+        events = []
+        def download(JOB):
+            JOB['segments'] = self.fetch(ffmpeg)
+        def remux(JOB):
+            TTG.remux_video(100, JOB['segments'], self.dir, self.dir, ffmpeg, 'Show', 0)
+        job = {'segments':None}
+        TTG.pipeline([job], [(download, 1), (remux, 1)], 1, lambda STAGE, JOB, ERROR: events.append((STAGE, ERROR)))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][0], 0)
+        self.assertEqual(events[0][1][0], IOError)
+
+class SpaceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def tags(self, STREAM, HANDBRAKE=0):
+        return [(BYTES, TAG) for PATH, BYTES, TAG in TTG.space_needed([(1, 100), (2, 200), (3, None)], 7, self.dir, self.dir, STREAM, HANDBRAKE)]
+
+    def test_staged(self):
+        self.assertEqual(self.tags(0, 1), [(300, 'mp4'), (300, 'temp'), (300, 'mkv')])
+
+    def test_streamed(self):
+        self.assertEqual(self.tags(1), [(300, 'mp4')])
+
+    def test_streamed_resume_counts_missing(self):
+        open(self.dir+'/7-00001.ts', 'wb').write('x'*100)
+        open(self.dir+'/7.progress', 'w').write('00001 100\n')
+        self.assertEqual(self.tags(1), [(300, 'mp4'), (200, 'temp')])
+
+    def test_reserve_and_release(self):
+        device = os.stat(self.dir).st_dev
+        before = TTG.SPACE.get(device, 0)
+        margin, TTG.SPACE_MARGIN = TTG.SPACE_MARGIN, 0
+        try:
+            reservation = TTG.space_reserve([(self.dir, 1000, 'temp'), (self.dir, 2000, 'mp4')])
+        finally:
+            TTG.SPACE_MARGIN = margin
+        self.assertEqual(TTG.SPACE[device], before+3000)
+        TTG.space_release(reservation, 'temp')
+        self.assertEqual(TTG.SPACE[device], before+2000)
+        TTG.space_release(reservation)
+        self.assertEqual(TTG.SPACE[device], before)
+
+    def test_clean(self):
+        for ID in ['7', '8', '9']:
+            open(self.dir+'/'+ID+'-00001.ts', 'wb').write('x'*100)
+            open(self.dir+'/'+ID+'.progress', 'w').write('00001 100\n')
+        open(self.dir+'/6-00001.ts', 'wb').write('x'*100)
+        DB = {'config':{}, 'ip':{'7':TTG.Recording(None, {'transfered':0}), '8':TTG.Recording(None, {'transfered':'complete'})}}
+        self.assertEqual(TTG.space_clean(self.dir, 0, DB), (5, 320))
+        self.assertEqual(sorted(os.listdir(self.dir)), ['7-00001.ts', '7.progress'])
+
+    def test_clean_without_db_keeps_checkpoints(self):
+        open(self.dir+'/8-00001.ts', 'wb').write('x'*100)
+        open(self.dir+'/8.progress', 'w').write('00001 100\n')
+        open(self.dir+'/6-00001.ts', 'wb').write('x'*100)
+        self.assertEqual(TTG.space_clean(self.dir, 0), (1, 100))
+        self.assertEqual(sorted(os.listdir(self.dir)), ['8-00001.ts', '8.progress'])
+
+#################################################################################################
+# Function to build the metadata a tablo gives for an episode
+def episode_meta(SEASON, EPISODE, STATE='finished', SERIES='Nova'):
+    return {'recSeason':{}, 'recSeries':{'jsonForClient':{'title':SERIES}},
+            'recEpisode':{'jsonForClient':{'seasonNumber':SEASON, 'episodeNumber':EPISODE, 'title':'Ep',
+                                           'airDate':'2014-10-12T20:00Z', 'video':{'state':STATE}}}}
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = TTG.get_list, TTG.get_meta
+        self.ids = {}
+        self.meta = {}
+        TTG.get_list = lambda IPADDR: {'ids':dict([(ID, IPADDR) for ID in self.ids.keys()]), 'digest':repr(sorted(self.ids.keys()))}
+        TTG.get_meta = lambda IPADDR, VIDEOID, CACHE=None: self.meta.get(VIDEOID)
+    def tearDown(self):
+        TTG.get_list, TTG.get_meta = self.saved
+
+    def test_reprocess_keeps_transfer_state(self):
+        DB = {}
+        self.ids = {'100':1}
+        self.meta = {'100':episode_meta(1, 2, 'recording')}
+        TTG.db_update(['ip'], DB, 1)
+        DB['ip']['100']['transfered'] = 'downloaded'
+        DB['ip']['100']['progress'] = '5/10'
+        self.meta = {'100':episode_meta(1, 2)}
+        DB, found, added, deleted, processed = TTG.db_update(['ip'], DB, 1)
+        self.assertEqual((found, added, deleted, processed), (1, 0, 0, 1))
+        self.assertEqual(DB['ip']['100']['status'], 'finished')
+        self.assertEqual(DB['ip']['100']['transfered'], 'downloaded')
+        self.assertEqual(DB['ip']['100']['progress'], '5/10')
+
+    def test_progress_after_removal(self):
+        DB = {}
+        self.ids = {'100':1}
+        self.meta = {'100':episode_meta(1, 2)}
+        TTG.db_update(['ip'], DB, 1)
+        progress = TTG.db_progress('unused.db', DB, 'ip', '100')
+        self.ids = {}
+        DB, found, added, deleted, processed = TTG.db_update(['ip'], DB, 1)
+        self.assertEqual(deleted, 1)
+        progress(1, 10)
+        self.assertFalse(DB['ip'].has_key('100'))
+
+    def test_unreachable_tablo_is_left_alone(self):
+        DB = {}
+        self.ids = {'100':1}
+        self.meta = {'100':episode_meta(1, 2)}
+        TTG.db_update(['ip', 'down'], DB, 1)
+        swept = dict(DB['config']['swept'])
+        def get_list(IPADDR):
+            if IPADDR == 'down':
+                raise IOError('no route to host')
+            return {'ids':{'100':IPADDR, '200':IPADDR}, 'digest':'2'}
+        TTG.get_list = get_list
+        self.meta['200'] = episode_meta(1, 3)
+        DB, found, added, deleted, processed = TTG.db_update(['ip', 'down'], DB, 1)
+        self.assertEqual((found, added, deleted), (2, 1, 0))
+        self.assertEqual(sorted(DB['down'].keys()), ['100'])
+        self.assertEqual(DB['config']['swept']['down'], swept['down'])
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = self.dir+'/tablo.db'
+    def tearDown(self):
+        if TTG.DB_CONN.has_key(self.file):
+            TTG.DB_CONN[self.file].close()
+            del(TTG.DB_CONN[self.file])
+        shutil.rmtree(self.dir)
+
+    def test_legacy_line(self):
+        meta = episode_meta(1, 2)
+        meta['proc'] = {'transfered':'complete', 'progress':'10/10'}
+        open(self.file, 'w').write(str({'complete':{}, 'ip':{'100':meta, '101':episode_meta(1, 3)}})+'\n')
+        DB = TTG.db_load(self.file)
+        self.assertTrue(os.path.exists(self.file+'.old'))
+        self.assertEqual(open(self.file, 'rb').read(16), 'SQLite format 3\000')
+        self.assertEqual(sorted(DB['ip'].keys()), ['100', '101'])
+        self.assertEqual(DB['ip']['100']['transfered'], 'complete')
+        self.assertEqual(DB['ip']['100']['progress'], '10/10')
+        self.assertEqual(DB['ip']['101']['transfered'], 0)
+        self.assertEqual(DB['ip']['100']['name'], 'Nova - S01E02 - Ep')
+        self.assertEqual(TTG.db_meta(self.file, 'ip', '101')['recEpisode']['jsonForClient']['episodeNumber'], 3)
+
+    def test_unreadable_legacy_line_is_left_alone(self):
+        line = "{'ip': {'100': set([1])}}\n"
+        open(self.file, 'w').write(line)
+        self.assertRaises(ValueError, TTG.db_load, self.file)
+        self.assertEqual(open(self.file).read(), line)
+        self.assertFalse(os.path.exists(self.file+'.old'))
+        self.assertFalse(TTG.DB_CONN.has_key(self.file))
+
+    def test_failed_import_is_rolled_back(self):
+        line = str({'ip':{'100':'not a recording'}})+'\n'
+        open(self.file, 'w').write(line)
+        self.assertRaises(Exception, TTG.db_load, self.file)
+        self.assertEqual(open(self.file).read(), line)
+        self.assertFalse(os.path.exists(self.file+'.old'))
+        self.assertFalse(TTG.DB_CONN.has_key(self.file))
+
+    def test_missing_directory_is_reported(self):
+        self.assertRaises(Exception, TTG.db_load, self.dir+'/missing/tablo.db')
+
+class MetaTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = TTG.tablo_request
+        self.reply = (200, {}, '')
+        TTG.tablo_request = lambda IPADDR, PATH, METHOD='GET', HEADERS={}: self.reply
+    def tearDown(self):
+        TTG.tablo_request = self.saved
+
+    def test_parse_json(self):
+        meta = TTG.meta_parse('{"recEpisode": {"jsonForClient": {"title": "Caf\\u00e9", "live": true, "cast": ["A"]}}}')
+        self.assertEqual(meta['recEpisode']['jsonForClient'], {'title':'Caf\xc3\xa9', 'live':True, 'cast':['A']})
+        self.assertEqual(type(meta.keys()[0]), str)
+
+    def test_parse_literal(self):
+        self.assertEqual(TTG.meta_parse("{'recMovie': {'jsonForClient': {'title': 'M'}}}\n"), {'recMovie':{'jsonForClient':{'title':'M'}}})
+
+    def test_parse_bad(self):
+        for text in ['', 'not meta', '[1, 2]', "__import__('os')"]:
+            self.assertEqual(TTG.meta_parse(text), None)
+
+    def test_get_meta(self):
+        self.reply = (200, {'etag':'"1"'}, '{"recSeason": {}}')
+        meta = TTG.get_meta('ip', 100)
+        self.assertEqual(meta['cache']['etag'], '"1"')
+        self.assertEqual(TTG.get_meta('ip', 100, meta['cache']), None)
+
+    def test_get_meta_failures(self):
+        for reply in [(404, {}, 'missing'), (200, {}, ''), (200, {}, '{truncated')]:
+            self.reply = reply
+            self.assertEqual(TTG.get_meta('ip', 100), None)
+
+class SegmentTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = TTG.tablo_request, TTG.time.sleep
+        self.replies = []
+        self.calls = [0]
+        def tablo_request(IPADDR, PATH, METHOD='GET', HEADERS={}):
+            self.calls[0] = self.calls[0] + 1
+            reply = self.replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+        TTG.tablo_request = tablo_request
+        TTG.time.sleep = lambda SECONDS: None
+    def tearDown(self):
+        TTG.tablo_request, TTG.time.sleep = self.saved
+        TTG.CONGESTION.clear()
+
+    def test_retries_network_and_invalid_segments(self):
+        segment = '\x47'*188
+        self.replies = [IOError('reset'), TTG.httplib.BadStatusLine(''), (500, {}, ''), (200, {}, 'junk'), (200, {}, segment)]
+        self.assertEqual(TTG.get_segment('ip', 100, 1, 4, 0), segment)
+        self.assertEqual(self.calls[0], 5)
+        self.assertEqual(TTG.CONGESTION['ip']['active'], 0)
+
+    def test_gives_up_after_retries(self):
+        self.replies = [IOError('reset')]*3
+        self.assertRaises(IOError, TTG.get_segment, 'ip', 100, 1, 2, 0)
+        self.assertEqual(self.calls[0], 3)
+
+    def test_other_errors_are_not_retried(self):
+        self.replies = [KeyError('bug'), (200, {}, '\x47'*188)]
+        self.assertRaises(KeyError, TTG.get_segment, 'ip', 100, 1, 3, 0)
+        self.assertEqual(self.calls[0], 1)
+        self.assertEqual(TTG.CONGESTION['ip']['active'], 0)
+
+class ListingTest(unittest.TestCase):
+    # rows as a tablo's lighttpd writes them
+    PVR = ('<tr><td class="n"><a href="../">Parent Directory</a>/</td><td class="m">&nbsp;</td><td class="s">- &nbsp;</td><td class="t">Directory</td></tr>\n'
+           '<tr><td class="n"><a href="33071/">33071</a>/</td><td class="m">2015-Jan-04 00:14:32</td><td class="s">- &nbsp;</td><td class="t">Directory</td></tr>\n'
+           '<tr><td class="n"><a href="0123/">0123</a>/</td><td class="m">2015-Jan-05 20:00:02</td><td class="s">- &nbsp;</td><td class="t">Directory</td></tr>\n')
+    def row(self, NAME, SIZE):
+        return '<tr><td class="n"><a href="'+NAME+'">'+NAME+'</a></td><td class="m">2014-Oct-12 20:00:01</td><td class="s">'+SIZE+'</td><td class="t">video/mp2t</td></tr>\n'
+    def setUp(self):
+        self.saved = TTG.tablo_get
+        self.pages = {}
+        TTG.tablo_get = lambda IPADDR, PATH: self.pages[PATH]
+    def tearDown(self):
+        TTG.tablo_get = self.saved
+
+    def test_segments(self):
+        page = self.row('00002.ts', '183.6K')+self.row('00001.ts', '2.0M')+self.row('00003.ts', '900')
+        self.assertEqual(TTG.parse_listing(page, '.ts'), [('00002', int(183.6*1024)), ('00001', 2*1024*1024), ('00003', 900)])
+        self.assertEqual(TTG.parse_listing(page, '/'), [])
+
+    def test_directories(self):
+        self.assertEqual(TTG.parse_listing(self.PVR+self.row('notes.txt', '1K'), '/'), [('33071', None), ('0123', None)])
+        self.assertEqual(TTG.parse_listing(self.PVR, '.ts'), [])
+
+    def test_get_list_keeps_ids_as_listed(self):
+        self.pages['/pvr'] = self.PVR
+        self.assertEqual(sorted(TTG.get_list('ip')['ids'].keys()), ['0123', '33071'])
+
+    def test_get_segs_in_order(self):
+        self.pages['/pvr/0123/segs'] = self.row('00010.ts', '1K')+self.row('00002.ts', '2K')
+        self.assertEqual(TTG.get_segs('ip', '0123'), [(2, 2048), (10, 1024)])
+
+class CheckSegmentTest(unittest.TestCase):
+    def test_valid(self):
+        TTG.check_segment('\x47'+'\x00'*187+'\x47'+'\x01'*187, {'content-length':'376'})
+        TTG.check_segment('\x47'+'\x00'*187, {})
+
+    def test_invalid(self):
+        for data, headers in [('\x47'+'\x00'*187, {'content-length':'376'}), ('', {}), ('\x47'*100, {}),
+                              ('\x47'+'\x00'*187+'\x00'*188, {}), ('<html>404</html>', {})]:
+            self.assertRaises(IOError, TTG.check_segment, data, headers)
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = self.dir+'/tablo.db'
+    def tearDown(self):
+        if TTG.DB_CONN.has_key(self.file):
+            TTG.DB_CONN[self.file].close()
+            del(TTG.DB_CONN[self.file])
+        shutil.rmtree(self.dir)
+    def broadcast(self, TITLE, AIRED):
+        meta = episode_meta(0, 0, SERIES='NFL Football')
+        meta['recEpisode']['jsonForClient']['title'] = TITLE
+        meta['recEpisode']['jsonForClient']['airDate'] = AIRED
+        return TTG.proc_meta(meta)
+
+    def test_keys(self):
+        self.assertEqual(TTG.catalog_key(TTG.proc_meta(episode_meta(1, 2, SERIES='Whose Line?'))), 'tv|whose line|s1e2')
+        self.assertEqual(TTG.catalog_key(self.broadcast('Bears at Packers', '2014-10-12T17:00Z')), 'tv|nfl football|2014-10-12T17:00Z|bears at packers')
+        movie = TTG.Recording(None, {'type':'movie', 'title':'The Movie!', 'date':2001})
+        self.assertEqual(TTG.catalog_key(movie), 'movie|the movie|2001')
+
+    def test_same_day_broadcasts_differ(self):
+        first = self.broadcast('Bears at Packers', '2014-10-12T17:00Z')
+        second = self.broadcast('Steelers at Browns', '2014-10-12T17:00Z')
+        later = self.broadcast('Bears at Packers', '2014-10-12T20:25Z')
+        self.assertEqual(len(dict([(TTG.catalog_key(PROC), 1) for PROC in [first, second, later]])), 3)
+        self.assertEqual(TTG.catalog_key(first), TTG.catalog_key(self.broadcast('Bears at Packers', '2014-10-12T17:00Z')))
+
+    def test_catalog(self):
+        open(self.dir+'/show.mp4', 'wb').write('video')
+        key = TTG.catalog_key(self.broadcast('Bears at Packers', '2014-10-12T17:00Z'))
+        self.assertEqual(TTG.catalog_find(self.file, key), None)
+        TTG.catalog_add(self.file, key, 'ip', '100', 'show', self.dir+'/show.mp4')
+        found = TTG.catalog_find(self.file, key)
+        self.assertEqual((found['ip'], found['id'], found['size'], found['md5']), ('ip', '100', 5, TTG.hashlib.md5('video').hexdigest()))
+        self.assertEqual(TTG.catalog_find(self.file, TTG.catalog_key(self.broadcast('Steelers at Browns', '2014-10-12T17:00Z'))), None)
+
+class PollTest(unittest.TestCase):
+    def test_get_end(self):
+        meta = episode_meta(1, 2, 'recording')
+        meta['recEpisode']['jsonForClient']['airDate'] = '2014-10-12T20:00Z'
+        self.assertEqual(TTG.get_end(meta), 0)
+        meta['recEpisode']['jsonForClient']['duration'] = 1800
+        self.assertEqual(TTG.get_end(meta), 1413144000+1800)
+        meta['recEpisode']['jsonForClient']['airDate'] = 'soon'
+        self.assertEqual(TTG.get_end(meta), 0)
+
+    def test_poll_due(self):
+        def rec(STATUS, ENDS):
+            return TTG.Recording(None, {'status':STATUS, 'ends':ENDS})
+        DB = {'ip':{'done':rec('finished', 0), 'later':rec('recording', 10000), 'ending':rec('recording', 1010),
+                    'unknown':rec('recording', 0), 'over':rec('recording', 100)}}
+        CHECKED = dict([(('ip', ID), 990) for ID in DB['ip'].keys()])
+        CHECKED[('ip', 'ending')] = 975
+        due, wait = TTG.poll_due(['ip'], DB, CHECKED, 1000, 20, 300, 900)
+        self.assertEqual(due, {('ip', 'ending'):1})
+        self.assertEqual(wait, 290)
+        CHECKED[('ip', 'ending')] = 1000
+        self.assertEqual(TTG.poll_due(['ip'], DB, CHECKED, 1000, 20, 300, 900), ({}, 20))
+        CHECKED[('ip', 'unknown')] = 0
+        due, wait = TTG.poll_due(['ip'], DB, CHECKED, 1000, 20, 300, 900)
+        self.assertEqual(due, {('ip', 'unknown'):1})
+        self.assertEqual(TTG.poll_due(['ip'], {'ip':{'done':rec('finished', 0)}}, {}, 1000, 20, 300), ({}, None))
+
+class JobQueueTest(unittest.TestCase):
+    def test_jobs_added_while_running(self):
+        QUEUE = TTG.job_queue()
+        done = []
+        first = TTG.threading.Event()
+        def stage(JOB):
+            if JOB == 'a':
+                first.wait(5)
+        def on_stage(STAGE, JOB, ERROR):
+            done.append((STAGE, JOB))
+        self.assertEqual(TTG.job_add(QUEUE, [('ip', 'a')], 'a'), 1)
+        t = TTG.threading.Thread(target=TTG.pipeline, args=(QUEUE, [(stage, 1), (stage, 1)], 1, on_stage))
+        t.start()
+        self.assertEqual(TTG.job_add(QUEUE, [('ip', 'a')], 'again'), 0)
+        self.assertEqual(TTG.job_add(QUEUE, [('ip', 'b')], 'b'), 1)
+        self.assertEqual(TTG.job_queued(QUEUE, [('ip', 'b')]), 1)
+        first.set()
+        TTG.job_close(QUEUE)
+        t.join(10)
+        self.assertFalse(t.isAlive())
+        self.assertEqual(sorted(done), [(0, 'a'), (0, 'b'), (1, 'a'), (1, 'b')])
+        self.assertEqual(TTG.job_queued(QUEUE, [('ip', 'a'), ('ip', 'b')]), 0)
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = self.dir+'/tablo.db'
+        DB = {'ip':{}}
+        for ID, meta in [('100', episode_meta(1, 2)), ('101', episode_meta(3, 1)), ('102', episode_meta(4, 7, 'recording')),
+                         ('103', episode_meta(2, 5, SERIES='Whose Line'))]:
+            DB['ip'][ID] = TTG.proc_meta(meta)
+            TTG.db_mark(DB, 'ip', ID)
+        DB['ip']['101']['transfered'] = 'complete'
+        self.DB = TTG.db_save(self.file, DB)
+    def tearDown(self):
+        TTG.DB_CONN[self.file].close()
+        del(TTG.DB_CONN[self.file])
+        shutil.rmtree(self.dir)
+    def search(self, QUERY):
+        return sorted([ID for IP, ID in TTG.db_search(self.file, QUERY).keys()])
+
+    def test_is_query(self):
+        self.assertTrue(TTG.search_is_query('series:Nova'))
+        self.assertTrue(TTG.search_is_query('Nova season:>=3'))
+        self.assertFalse(TTG.search_is_query('Nova'))
+        self.assertFalse(TTG.search_is_query('Nova: The Series'))
+        self.assertFalse(TTG.search_is_query('^Nova.*S0[1-3]'))
+
+    def test_fields(self):
+        self.assertEqual(self.search('series:nova'), ['100', '101', '102'])
+        self.assertEqual(self.search('series:"Whose Line"'), ['103'])
+        self.assertEqual(self.search('season:>=3'), ['101', '102'])
+        self.assertEqual(self.search('series:Nova status:finished season:<3'), ['100'])
+        self.assertEqual(self.search('transferred:complete'), ['101'])
+        self.assertEqual(self.search('whos'), ['103'])
+        self.assertEqual(self.search('nova'), ['100', '101', '102'])
+
+    def test_match(self):
+        self.assertEqual(TTG.search_match(self.file, ['ip'], self.DB, 'Nova - S0[13]', 1, 0), [('ip', '100'), ('ip', '101')])
+        self.assertEqual(TTG.search_match(self.file, ['ip'], self.DB, 'series:Nova', 0, 1), [])
+        self.assertEqual(TTG.search_match(self.file, ['ip'], self.DB, 'line', 1, 0), [('ip', '103')])
+
+    def test_match_skips_removed(self):
+        del(self.DB['ip']['100'])
+        self.assertEqual(TTG.search_match(self.file, ['ip'], self.DB, 'series:Nova', 1, 0), [('ip', '101'), ('ip', '102')])
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def load(self, TEXT):
+        open(self.dir+'/watch.txt', 'w').write(TEXT)
+        return TTG.watch_load(self.dir+'/watch.txt', '/out', 1, 1, 0)
+
+    def test_rules(self):
+        rules = self.load('# comment\n\nseries:Nova -tv -handbrake\n"Whose Line" -output:"/other dir" -movies\n')
+        self.assertEqual([(rule['search'], rule['output'], rule['tv'], rule['movies'], rule['handbrake']) for rule in rules],
+                         [('series:Nova', '/out', 1, 0, 1), ('Whose Line', '/other dir', 0, 1, 0)])
+
+    def test_bad_option(self):
+        self.assertRaises(ValueError, self.load, 'Nova -bogus\n')
+
+class OrderTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = TTG.get_segs
+        self.sizes = {}
+        def get_segs(IPADDR, VIDEOID):
+            if self.sizes[VIDEOID] is None:
+                raise IOError('no listing')
+            return [(1, self.sizes[VIDEOID]), (2, None)]
+        TTG.get_segs = get_segs
+    def tearDown(self):
+        TTG.get_segs = self.saved
+    def jobs(self):
+        def job(IP, ID, RANK, TYPE, DATE):
+            return {'item':[IP, ID, ID, 'finished', 0, TTG.Recording(None, {'type':TYPE, 'date':DATE, 'airdate':DATE}), None],
+                    'rank':RANK, 'segs':None}
+        return [job('b', 'b1', 0, 'tv', '2014-10-03'), job('a', 'a1', 1, 'tv', '2014-10-01'),
+                job('a', 'a2', 0, 'movie', '2014-10-05'), job('b', 'b2', 1, 'tv', '2014-10-02')]
+    def order(self, ORDER):
+        return [JOB['item'][1] for JOB in TTG.order_jobs(self.jobs(), ORDER, ['a', 'b'], 2)]
+
+    def test_watch(self):
+        self.assertEqual(self.order('watch'), ['a2', 'b1', 'a1', 'b2'])
+
+    def test_newest(self):
+        self.assertEqual(self.order('newest'), ['a2', 'b1', 'b2', 'a1'])
+
+    def test_shortest_keeps_listings(self):
+        self.sizes = {'a1':300, 'a2':None, 'b1':100, 'b2':200}
+        jobs = TTG.order_jobs(self.jobs(), 'shortest', ['a', 'b'], 2)
+        self.assertEqual([JOB['item'][1] for JOB in jobs], ['b1', 'b2', 'a1', 'a2'])
+        self.assertEqual(jobs[0]['segs'], [(1, 100), (2, None)])
+        self.assertEqual(jobs[3]['segs'], None)
+
+    def test_shortest_reuses_listings(self):
+        self.sizes = {'a1':300, 'a2':50, 'b1':100, 'b2':None}
+        jobs = self.jobs()
+        jobs[3]['segs'] = [(1, 10)]
+        self.assertEqual([JOB['item'][1] for JOB in TTG.order_jobs(jobs, 'shortest', ['a', 'b'], 2)], ['b2', 'a2', 'b1', 'a1'])
+
+
+class PipelineTest(unittest.TestCase):
+    def test_limit_per_key(self):
+        lock = TTG.threading.Lock()
+        busy, peak, order = {}, {}, []
+        def download(JOB):
+            lock.acquire()
+            busy[JOB['ip']] = busy.get(JOB['ip'], 0) + 1
+            peak[JOB['ip']] = max(peak.get(JOB['ip'], 0), busy[JOB['ip']])
+            order.append(JOB['n'])
+            lock.release()
+            TTG.time.sleep(0.02)
+            lock.acquire()
+            busy[JOB['ip']] = busy[JOB['ip']] - 1
+            lock.release()
+        def finish(JOB):
+            if JOB['n'] == 3:
+                raise IOError('failed')
+        events = []
+        jobs = [{'ip':['a', 'b'][n >= 6], 'n':n} for n in range(9)]
+        TTG.pipeline(jobs, [(download, 4), (finish, 1)], 2, lambda STAGE, JOB, ERROR: events.append((STAGE, JOB['n'], ERROR is None)), (lambda JOB: JOB['ip'], 2))
+        self.assertEqual(peak, {'a':2, 'b':2})
+        self.assertEqual(sorted(order[:4]), [0, 1, 6, 7])
+        self.assertEqual(len([event for event in events if event[0] == 0]), 9)
+        self.assertEqual(sorted([event[1] for event in events if event[0] == 1 and event[2]]), [0, 1, 2, 4, 5, 6, 7, 8])
+        self.assertTrue((1, 3, False) in events)
+
+class JsonTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = self.dir+'/tablo.db'
+        self.stdout = sys.stdout
+    def tearDown(self):
+        sys.stdout = self.stdout
+        TTG.DB_CONN[self.file].close()
+        del(TTG.DB_CONN[self.file])
+        shutil.rmtree(self.dir)
+    def rows(self, DB):
+        sys.stdout = output = tempfile.TemporaryFile()
+        try:
+            TTG.db_print_json(['ip'], DB)
+        finally:
+            sys.stdout = self.stdout
+        output.seek(0)
+        return [TTG.json.loads(line) for line in output.readlines()]
+
+    def test_same_types_before_and_after_loading(self):
+        DB = {'ip':{'100':TTG.proc_meta(episode_meta(2, 5)), '101':TTG.proc_meta(episode_meta(1, 1))}}
+        DB['ip']['101']['transfered'] = 'complete'
+        for ID in DB['ip'].keys():
+            TTG.db_mark(DB, 'ip', ID)
+        before = self.rows(DB)
+        TTG.db_save(self.file, DB)
+        self.assertEqual(self.rows(TTG.db_load(self.file)), before)
+        self.assertEqual([(row['season'], row['episode'], row['transferred']) for row in before], [(2, 5, None), (1, 1, 'complete')])
+        self.assertFalse(before[0].has_key('transfered'))
+
+if __name__ == '__main__':
+    unittest.main()